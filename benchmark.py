@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
+
+from models import MLP, ConvNet, ResNet, DeepConvNet, Siamese
+from losses import AuxiliaryLoss
+from evaluation import percentile
+
+
+# name: (model, model parameters, use auxiliary loss), as in test.py
+MODEL_CONFIGS = {"MLP": (MLP, [2], False),
+                 "ConvNet": (ConvNet, [2], False),
+                 "ResNet": (ResNet, [10, 2, 2, 128], False),
+                 "DeepConvNet": (DeepConvNet, [False], False),
+                 "DeepConvNet_aux": (DeepConvNet, [True], True),
+                 "Siamese": (Siamese, [False], False),
+                 "Siamese_aux": (Siamese, [True], True)}
+
+MODES = ["forward", "forward_backward"]
+
+# models with an activation checkpointing mode (checkpoint_segment_size)
+CHECKPOINTING_MODELS = (ResNet, DeepConvNet, Siamese)
+
+
+def random_batch(batch_size, use_auxiliary_loss):
+    '''
+    Random pairs of images with random targets
+    '''
+    inputs = torch.rand(batch_size, 2, 14, 14) * 255
+    classes = torch.randint(0, 10, (batch_size, 2))
+    targets = (classes[:, 0] <= classes[:, 1]).long()
+    if use_auxiliary_loss:
+        targets = torch.cat((targets.view(-1, 1), classes), dim=1)
+    return inputs, targets
+
+
+def time_steps(step, n_runs, n_warmup):
+    '''
+    Wall times in seconds of 'n_runs' calls of 'step' (after 'n_warmup' calls)
+    '''
+    for _ in range(n_warmup):
+        step()
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark_model(name, mode, batch_size, n_runs=50, n_warmup=5):
+    '''
+    Latency (p50, p99 in ms) and throughput (pairs per second) of one model
+
+    mode 'forward' is an inference step (evaluation mode, no autograd),
+    mode 'forward_backward' computes the loss and the gradients (training mode)
+    '''
+    model_class, params, use_auxiliary_loss = MODEL_CONFIGS[name]
+    model = model_class(*params)
+    inputs, targets = random_batch(batch_size, use_auxiliary_loss)
+    if mode == "forward":
+        model.eval()
+
+        def step():
+            with torch.inference_mode():
+                model(inputs)
+    elif mode == "forward_backward":
+        model.train()
+        criterion = AuxiliaryLoss(0.3, 0.7) if use_auxiliary_loss else torch.nn.CrossEntropyLoss()
+
+        def step():
+            model.zero_grad(set_to_none=True)
+            criterion(model(inputs), targets).backward()
+    else:
+        raise ValueError("Unknown mode: {}".format(mode))
+
+    times = time_steps(step, n_runs, n_warmup)
+    return {"model": name,
+            "mode": mode,
+            "batch_size": batch_size,
+            "threads": torch.get_num_threads(),
+            "p50_ms": 1000 * percentile(times, 50),
+            "p99_ms": 1000 * percentile(times, 99),
+            "throughput": batch_size * len(times) / sum(times)}
+
+
+def run_benchmarks(names, modes, batch_sizes, threads, n_runs=50, n_warmup=5):
+    '''
+    Sweep models, modes, batch sizes and number of threads
+    '''
+    results = []
+    for n_threads in threads:
+        torch.set_num_threads(n_threads)
+        for name in names:
+            for mode in modes:
+                for batch_size in batch_sizes:
+                    # BatchNorm needs more than one sample in training mode
+                    if mode == "forward_backward" and batch_size < 2:
+                        continue
+                    result = benchmark_model(name, mode, batch_size, n_runs, n_warmup)
+                    print("{model:16s} {mode:17s} batch {batch_size:4d} threads {threads:3d}: "
+                          "p50 {p50_ms:9.3f} ms  p99 {p99_ms:9.3f} ms  {throughput:10.1f} pairs/s".format(**result))
+                    results.append(result)
+    return results
+
+
+def memory_setup(name, batch_size, segment_size, device):
+    '''
+    Model in training mode with activation checkpointing in segments of 'segment_size' blocks (0: no checkpointing),
+    a random batch and the criterion of a memory benchmark
+    '''
+    model_class, params, use_auxiliary_loss = MODEL_CONFIGS[name]
+    model = model_class(*params, checkpoint_segment_size=segment_size or None).to(device).train()
+    inputs, targets = random_batch(batch_size, use_auxiliary_loss)
+    criterion = AuxiliaryLoss(0.3, 0.7) if use_auxiliary_loss else torch.nn.CrossEntropyLoss()
+    return model, inputs.to(device), targets.to(device), criterion
+
+
+def max_rss_bytes():
+    '''
+    High-water mark of the resident memory of this process (ru_maxrss is in KiB on Linux, in bytes on macOS)
+    '''
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def cpu_step_peak_bytes(name, batch_size, segment_size, n_threads):
+    '''
+    Growth of the resident memory high-water mark during the first training step of a fresh process
+
+    everything the step allocates is counted: activations saved for backward, checkpointed segment inputs,
+    activations recomputed during backward, gradients and temporaries
+    '''
+    torch.set_num_threads(n_threads)
+    model, inputs, targets, criterion = memory_setup(name, batch_size, segment_size, 'cpu')
+    before = max_rss_bytes()
+    criterion(model(inputs), targets).backward()
+    return max_rss_bytes() - before
+
+
+def benchmark_memory(name, batch_size, segment_size, n_runs=20, n_warmup=3):
+    '''
+    Peak memory and step time of a training step with activation checkpointing in segments of
+    'segment_size' blocks (0: no checkpointing)
+
+    on GPU the peak is the maximum allocated memory during a step, on CPU the growth of the resident memory
+    high-water mark during a step, measured in a new process (see cpu_step_peak_bytes): the high-water mark
+    of this process can not be reset and freed memory stays cached by the allocator
+    '''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model, inputs, targets, criterion = memory_setup(name, batch_size, segment_size, device)
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        criterion(model(inputs), targets).backward()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    if device == 'cuda':
+        step()
+        torch.cuda.reset_peak_memory_stats()
+        step()
+        peak_bytes = torch.cuda.max_memory_allocated()
+    else:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            peak_bytes = pool.submit(cpu_step_peak_bytes, name, batch_size, segment_size,
+                                     torch.get_num_threads()).result()
+    times = time_steps(step, n_runs, n_warmup)
+    return {"model": name,
+            "batch_size": batch_size,
+            "segment_size": segment_size,
+            "device": device,
+            "peak_mb": peak_bytes / 2**20,
+            "p50_ms": 1000 * percentile(times, 50)}
+
+
+def memory_report(names, batch_sizes, segment_sizes, n_runs=20, n_warmup=3):
+    '''
+    Peak memory against step time of the models with activation checkpointing, for every segment size
+    '''
+    results = []
+    for name in names:
+        if not issubclass(MODEL_CONFIGS[name][0], CHECKPOINTING_MODELS):
+            continue
+        for batch_size in batch_sizes:
+            if batch_size < 2:
+                continue
+            for segment_size in segment_sizes:
+                result = benchmark_memory(name, batch_size, segment_size, n_runs, n_warmup)
+                print("{model:16s} batch {batch_size:4d} segment {segment_size:3d}: "
+                      "peak {peak_mb:9.1f} MB  step {p50_ms:9.3f} ms".format(**result))
+                results.append(result)
+    return results
+
+
+def result_key(result):
+    return (result["model"], result["mode"], result["batch_size"], result["threads"])
+
+
+def compare_with_baseline(results, baseline, tolerance=0.1):
+    '''
+    Compare the throughput with a baseline, returns the results slower than (1 - tolerance) * baseline
+    '''
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        reference = baseline_results.get(result_key(result))
+        if reference is None:
+            continue
+        ratio = result["throughput"] / reference["throughput"]
+        result["baseline_ratio"] = ratio
+        flag = ""
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+            flag = "  <-- REGRESSION"
+        print("{:16s} {:17s} batch {:4d} threads {:3d}: {:6.2f}x baseline{}".format(*result_key(result), ratio, flag))
+    return regressions
+
+
+def precision_report(names, nb_epochs=5, n_experiments=1):
+    '''
+    Training time speedup and error rate change of bfloat16 autocast against float32 for every model
+    '''
+    from training import compare_precision
+    reports = {}
+    for name in names:
+        model_class, params, use_auxiliary_loss = MODEL_CONFIGS[name]
+        print("\nModel:", name)
+        reports[name] = compare_precision(model_class, *params, n_experiments=n_experiments,
+                                          use_auxiliary_loss=use_auxiliary_loss, model_name=name,
+                                          nb_epochs=nb_epochs)
+    return reports
+
+
+def environment():
+    return {"torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput and latency benchmark of the models')
+    parser.add_argument('--models', type=str, nargs='+', default=list(MODEL_CONFIGS), help='Models to benchmark')
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, help='forward and/or forward_backward')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16, 64, 256], help='Batch sizes')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, os.cpu_count() or 1], help='Numbers of threads')
+    parser.add_argument('--n_runs', type=int, default=50, help='Timed steps per configuration (default 50)')
+    parser.add_argument('--n_warmup', type=int, default=5, help='Warm-up steps per configuration (default 5)')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='Results file (json)')
+    parser.add_argument('--baseline', type=str, default=None, help='Baseline results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Accepted throughput loss (default 0.1)')
+    parser.add_argument('--compare_precision', action='store_true', default=False,
+                        help='Train every model in fp32 and bf16 and compare time and error rates instead')
+    parser.add_argument('--nb_epochs', type=int, default=5, help='Epochs of --compare_precision (default 5)')
+    parser.add_argument('--memory', action='store_true', default=False,
+                        help='Peak memory against step time of activation checkpointing instead')
+    parser.add_argument('--segment_sizes', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='Checkpointed blocks per segment of --memory, 0 disables it (default 0 1 2 4)')
+    args = parser.parse_args()
+
+    if args.memory:
+        results = memory_report(args.models, args.batch_sizes, args.segment_sizes, args.n_runs, args.n_warmup)
+        with open(args.output, 'w') as f:
+            json.dump({"environment": environment(), "memory": results}, f, indent=2)
+        print("Results saved in:", args.output)
+        sys.exit(0)
+
+    if args.compare_precision:
+        reports = precision_report(args.models, args.nb_epochs)
+        with open(args.output, 'w') as f:
+            json.dump({"environment": environment(), "precision": reports}, f, indent=2)
+        print("Results saved in:", args.output)
+        sys.exit(0)
+
+    results = run_benchmarks(args.models, args.modes, args.batch_sizes, sorted(set(args.threads)),
+                             args.n_runs, args.n_warmup)
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+    with open(args.output, 'w') as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2)
+    print("Results saved in:", args.output)
+    if regressions:
+        print("{} configurations are slower than the baseline".format(len(regressions)))
+        sys.exit(1)
@@ -0,0 +1,80 @@
+import os
+import threading
+import torch
+
+
+def clone_state(state, device=None):
+    '''
+    Detached copy of a (possibly nested) state dict, optionally moved to 'device'
+    '''
+    if torch.is_tensor(state):
+        return state.detach().to(device, copy=True) if device is not None else state.detach().clone()
+    if isinstance(state, dict):
+        return {key: clone_state(value, device) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(clone_state(value, device) for value in state)
+    return state
+
+
+def load_checkpoint(path):
+    '''
+    Load a checkpoint written by CheckpointWriter
+    '''
+    return torch.load(path, map_location='cpu')
+
+
+class CheckpointWriter:
+    '''
+    Asynchronous Checkpoint Writer
+
+    The training loop hands over the checkpoint (copied to the CPU) and a background thread writes it
+    to disk, so that the training step never waits for the disk.
+    Files are written to a temporary path and renamed, so an interruption never corrupts the last checkpoint.
+    If the writer falls behind only the most recent pending checkpoint is written.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._pending = None
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, checkpoint):
+        '''
+        Schedule the writing of 'checkpoint' (a dict of states)
+        '''
+        checkpoint = clone_state(checkpoint, device='cpu')
+        with self._condition:
+            self._pending = checkpoint
+            self._condition.notify()
+
+    def close(self):
+        '''
+        Wait for the pending checkpoint to be written and stop the writer
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                checkpoint, self._pending = self._pending, None
+            try:
+                tmp_path = self.path + '.tmp'
+                torch.save(checkpoint, tmp_path)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                self._error = e
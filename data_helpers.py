@@ -3,6 +3,9 @@ from torch import nn
 from torch import optim
 from torch.nn import functional as F
 import math
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from torch.nn.modules.loss import _Loss
 from torch import Tensor
@@ -78,6 +81,109 @@ class DigitsDataset:
 
 
 
+class IndexPairLoader:
+    '''
+    Loader of Index Pairs (with or without Data Augmentation)
+
+    The pairs are int32 index pairs (M, 2) into a shared uint8 digit bank (see load_digit_bank): the images
+    of a batch are gathered from the bank and converted to float (normalized if mean and std are given)
+    only when the batch is built. Without augment the pairs are iterated over in order, with augment == True
+    every one of the 2M digits of the pairs is paired with a random partner among them: a new pairing only
+    costs the random indices.
+
+    The partners of batch k of an epoch are drawn from a generator seeded by (seed, rank, epoch, k), so batches
+    can be built in any order or in parallel (see PrefetchLoader) and are reproducible for a given seed
+    (drawn from the torch RNG if not given). Every iteration is a new epoch, unless set by set_epoch.
+
+    With world_size > 1 (distributed training) the loader of process 'rank' iterates only over its shard:
+    the rank-th of 'world_size' contiguous blocks of the pairs (digits with augment, the remainder is
+    dropped so that all the processes make the same number of steps), partners are still drawn from all
+    the digits. All the processes must use the same seed.
+    '''
+    def __init__(self, images: Tensor, labels: Tensor, idx: Tensor, batch_size: int, use_auxiliary_loss: bool,
+                 augment=False, seed=None, rank=0, world_size=1, mean=None, std=None):
+        self.images = images
+        self.labels = labels
+        self.digits = idx.reshape(-1)
+        # digits (2M) with augmentation, pairs (M, 2) without
+        self.anchors = self.digits if augment else idx
+        self.batch_size = batch_size
+        self.use_auxiliary_loss = use_auxiliary_loss
+        self.augment = augment
+        if seed is None and augment:
+            seed = int(torch.randint(2**62, (1,)))
+        self.seed = seed
+        self.rank = rank
+        self.shard_size = self.anchors.size(0) // world_size if world_size > 1 else self.anchors.size(0)
+        self.mean = mean
+        self.std = std
+        self.epoch = 0
+
+    def __len__(self):
+        return math.ceil(self.shard_size / self.batch_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batch(self, epoch, k):
+        '''
+        Batch k of epoch 'epoch'
+        '''
+        offset = self.rank * self.shard_size
+        anchors = self.anchors[offset + k * self.batch_size:offset + min((k + 1) * self.batch_size, self.shard_size)]
+        if self.augment:
+            generator = torch.Generator().manual_seed(hash((self.seed, self.rank, epoch, k)) % 2**63)
+            partners = torch.randint(low=0, high=self.digits.size(0), size=anchors.size(), generator=generator)
+            idx = torch.stack((anchors, self.digits[partners]), dim=1)
+        else:
+            idx = anchors
+        classes = self.labels[idx.long()]
+        train_target = (classes[:, 0] <= classes[:, 1]).long()
+        return (gather_pairs(self.images, idx, self.mean, self.std),
+                build_targets(train_target, classes, self.use_auxiliary_loss))
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1
+        for k in range(len(self)):
+            yield self.batch(epoch, k)
+
+
+
+class PrefetchLoader:
+    '''
+    Background Data Pipeline
+
+    Builds the batches of a loader (IndexPairLoader, CorpusLoader) in 'n_threads' threads while the
+    model trains on the previous ones. At most 'prefetch' batches are in flight (bounded queue) and they
+    are returned in order. Since a batch only depends on (epoch, k) the results are the same
+    whatever the number of threads.
+    '''
+    def __init__(self, loader, n_threads=2, prefetch=4):
+        self.loader = loader
+        self.n_threads = n_threads
+        self.prefetch = max(prefetch, 1)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def set_epoch(self, epoch):
+        self.loader.set_epoch(epoch)
+
+    def __iter__(self):
+        epoch = self.loader.epoch
+        self.loader.epoch += 1
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            pending = deque()
+            for k in range(len(self.loader)):
+                pending.append(pool.submit(self.loader.batch, epoch, k))
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+
 # returns a split in train and validation data
 def random_split(train_input, train_target, train_classes, percentage_val=0.1):
     '''
@@ -108,3 +214,116 @@ def build_target(train_target, train_classes, use_auxiliary_loss):
         return target.long()
 
 
+def build_targets(train_target, train_classes, use_auxiliary_loss):
+    '''
+    Vectorized version of build_target for a whole batch
+    '''
+    if not use_auxiliary_loss:
+        return train_target.view(-1).long()
+    else:
+        return torch.cat((train_target.view(-1, 1), train_classes.view(-1, 2)), dim=1).long()
+
+
+
+# pooled digit banks already mapped by this process
+_digit_banks = {}
+
+
+def get_data_dir():
+    '''
+    Where the PyTorch data are located ($PYTORCH_DATA_DIR or './data'), as in dlc_practical_prologue
+    '''
+    data_dir = os.environ.get('PYTORCH_DATA_DIR')
+    if data_dir is None:
+        data_dir = './data'
+    return data_dir
+
+
+def load_digit_bank(train=True, data_dir=None):
+    '''
+    Pooled MNIST Digit Bank
+
+    Returns all the MNIST images of the requested split, average pooled to 14x14, as a memory-mapped
+    uint8 tensor (N, 1, 14, 14) together with their labels (N).
+    The bank is built once from torchvision and cached in <data_dir>/mnist/pooled/, later calls
+    (also from other processes) only map the cache. Pooled pixels are rounded to the closest integer.
+    '''
+    if data_dir is None:
+        data_dir = get_data_dir()
+    split = 'train' if train else 't10k'
+    key = (os.path.abspath(data_dir), split)
+    if key in _digit_banks:
+        return _digit_banks[key]
+
+    cache_dir = os.path.join(data_dir, 'mnist', 'pooled')
+    images_path = os.path.join(cache_dir, split + '-images-14x14.u8')
+    labels_path = os.path.join(cache_dir, split + '-labels.pt')
+    if not (os.path.exists(images_path) and os.path.exists(labels_path)):
+        build_digit_bank(train, data_dir, images_path, labels_path)
+
+    labels = torch.load(labels_path)
+    images = torch.from_file(images_path, shared=False, size=labels.size(0) * 14 * 14, dtype=torch.uint8)
+    images = images.view(-1, 1, 14, 14)
+    _digit_banks[key] = (images, labels)
+    return images, labels
+
+
+def build_digit_bank(train, data_dir, images_path, labels_path):
+    '''
+    Decode and pool the MNIST split once and write the files of the digit bank
+    '''
+    from torchvision import datasets
+    mnist_set = datasets.MNIST(data_dir + '/mnist/', train = train, download = True)
+    images = F.avg_pool2d(mnist_set.data.view(-1, 1, 28, 28).float(), kernel_size = 2)
+    images = images.round().clamp(0, 255).to(torch.uint8)
+
+    os.makedirs(os.path.dirname(images_path), exist_ok=True)
+    # write to temporary files and rename, so that concurrent runs never read a partial bank
+    suffix = '.tmp' + str(os.getpid())
+    with open(images_path + suffix, 'wb') as f:
+        f.write(images.numpy().tobytes())
+    torch.save(mnist_set.targets.clone(), labels_path + suffix)
+    os.replace(images_path + suffix, images_path)
+    os.replace(labels_path + suffix, labels_path)
+
+
+def bank_to_pairs(nb, images, labels):
+    '''
+    Sample 'nb' pairs of distinct digits from a digit bank, as mnist_to_pairs in dlc_practical_prologue
+    '''
+    a = torch.randperm(images.size(0))
+    a = a[:2 * nb].view(nb, 2)
+    input = images[a.view(-1)].view(nb, 2, images.size(2), images.size(3)).float()
+    classes = labels[a]
+    target = (classes[:, 0] <= classes[:, 1]).long()
+    return input, target, classes
+
+
+def bank_to_index_pairs(nb, labels):
+    '''
+    Same sampling as bank_to_pairs, but the pairs are int32 indices (nb, 2) into the digit bank instead of images
+    '''
+    a = torch.randperm(labels.size(0))
+    a = a[:2 * nb].view(nb, 2)
+    classes = labels[a]
+    target = (classes[:, 0] <= classes[:, 1]).long()
+    return a.int(), target, classes
+
+
+def gather_pairs(images, idx, mean=None, std=None):
+    '''
+    Two channel float images (B, 2, 14, 14) of the index pairs 'idx' (B, 2) into a uint8 digit bank (N, 1, 14, 14),
+    normalized with 'mean' and 'std' if given
+    '''
+    pairs = images[idx.reshape(-1).long()].view(idx.size(0), 2, images.size(2), images.size(3)).float()
+    if mean is not None:
+        pairs = (pairs - mean) / std
+    return pairs
+
+
+def generate_pair_sets(nb, data_dir=None):
+    '''
+    Same as dlc_practical_prologue.generate_pair_sets, but sampling from the cached pooled digit banks
+    '''
+    return bank_to_pairs(nb, *load_digit_bank(True, data_dir)) + \
+           bank_to_pairs(nb, *load_digit_bank(False, data_dir))
@@ -0,0 +1,100 @@
+import os
+import json
+import argparse
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import models
+from training import run_experiment
+
+
+def init_distributed(rank, world_size, backend='gloo', master_addr='127.0.0.1', master_port=29500):
+    '''
+    Join the process group of a distributed training
+
+    MASTER_ADDR and MASTER_PORT are used if already set (e.g. by torchrun), otherwise 'master_addr' and 'master_port'
+    '''
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def distributed_worker(rank, world_size, model_name, model_params, seed, n_threads, kwargs, results=None,
+                       master_port=29500):
+    '''
+    One process of a distributed experiment
+
+    builds the model 'model_name' of models.py and runs training.run_experiment on its shard of the data,
+    rank 0 puts the errors in the 'results' queue (if given)
+    '''
+    init_distributed(rank, world_size, master_port=master_port)
+    try:
+        torch.set_num_threads(n_threads)
+        # same seed in all the processes: same data, same split and same initial weights
+        torch.manual_seed(seed)
+        model = getattr(models, model_name)(*model_params)
+        _, _, errors = run_experiment(model, rank=rank, world_size=world_size, **kwargs)
+        if rank == 0 and results is not None:
+            results.put(tuple(float(error) for error in errors))
+    finally:
+        dist.destroy_process_group()
+    return errors
+
+
+def run_distributed_experiment(model_name, model_params, world_size, seed=0, master_port=29500, **kwargs):
+    '''
+    Run one experiment (see training.run_experiment and its keyword arguments 'kwargs') with data-parallel
+    training over 'world_size' local processes, each one with cpu_count / world_size threads
+
+    'batch_size' is the batch size of every process. Returns the (train, validation, test) errors of rank 0.
+    '''
+    n_threads = max(1, (os.cpu_count() or 1) // world_size)
+    results = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(distributed_worker,
+             args=(world_size, model_name, model_params, seed, n_threads, kwargs, results, master_port),
+             nprocs=world_size, join=True)
+    return results.get()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distributed data-parallel training (gloo backend)',
+                                     epilog='Launched with torchrun (e.g. on several nodes) every call is one process '
+                                            'of the group, otherwise --nprocs local processes are spawned')
+    parser.add_argument('--model', type=str, default='DeepConvNet', help='Model class in models.py (default DeepConvNet)')
+    parser.add_argument('--params', type=str, default='[false]', help='Model parameters as a json list (default [false])')
+    parser.add_argument('--nprocs', type=int, default=2, help='Number of local processes (default 2)')
+    parser.add_argument('--master_port', type=int, default=29500, help='Rendezvous port of the local processes')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of all the processes (default 0)')
+    parser.add_argument('--use_auxiliary_loss', action='store_true', default=False, help='Train with the auxiliary loss')
+    parser.add_argument('--augment', action='store_true', default=False, help='Use data augmentation')
+    parser.add_argument('--nb_epochs', type=int, default=25, help='Number of epochs (default 25)')
+    parser.add_argument('--batch_size', type=int, default=50, help='Batch size of every process (default 50)')
+    parser.add_argument('--lr', type=float, default=5e-4, help='Learning rate (default 5e-4)')
+    parser.add_argument('--weight_decay', type=float, default=0.1, help='Weight decay (default 0.1)')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint path (written by rank 0)')
+    parser.add_argument('--checkpoint_every', type=int, default=1, help='Epochs between checkpoints (default 1)')
+    parser.add_argument('--resume', action='store_true', default=False, help='Resume from --checkpoint')
+    args = parser.parse_args()
+
+    kwargs = dict(use_auxiliary_loss=args.use_auxiliary_loss,
+                  augment=args.augment,
+                  nb_epochs=args.nb_epochs,
+                  batch_size=args.batch_size,
+                  lr=args.lr,
+                  weight_decay=args.weight_decay,
+                  model_name=args.model,
+                  plot=False,
+                  checkpoint_path=args.checkpoint,
+                  checkpoint_every=args.checkpoint_every,
+                  resume=args.resume)
+    model_params = json.loads(args.params)
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        # launched by torchrun
+        world_size = int(os.environ['WORLD_SIZE'])
+        n_threads = max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', world_size)))
+        distributed_worker(int(os.environ['RANK']), world_size, args.model, model_params, args.seed, n_threads, kwargs)
+    else:
+        errors = run_distributed_experiment(args.model, model_params, args.nprocs, seed=args.seed,
+                                            master_port=args.master_port, **kwargs)
+        print('Errors (train, validation, test):', errors)
@@ -0,0 +1,219 @@
+import copy
+import time
+import torch
+from torch import optim
+from torch.func import stack_module_state, functional_call, vmap
+
+from models import count_parameters
+from losses import to_float32
+from data_helpers import random_split, IndexPairLoader, load_digit_bank, bank_to_index_pairs, gather_pairs
+from evaluation import precision_context
+
+
+def flatten_replicas(output):
+    '''
+    Merge the replica and batch dimensions (K, B, ...) -> (K * B, ...) of an output, or of every tensor of
+    nested tuples / lists of outputs (e.g. (x, aux_preds) of the models with auxiliary loss)
+    '''
+    if isinstance(output, (tuple, list)):
+        return type(output)(flatten_replicas(out) for out in output)
+    return output.flatten(0, 1)
+
+
+def select_replica(output, k):
+    '''
+    Output of replica k, the nested tuples / lists of outputs keep their structure
+    '''
+    if isinstance(output, (tuple, list)):
+        return type(output)(select_replica(out, k) for out in output)
+    return output[k]
+
+
+class Ensemble:
+    '''
+    Vectorized Ensemble
+
+    K replicas of the same architecture with their parameters and buffers stacked along a first dimension
+    (torch.func.stack_module_state) and evaluated together with vmap: one forward step runs all the
+    replicas, each one with its own batch (inputs of shape (K, B, ...)) or with the same one (B, ...).
+    Dropout draws different masks for every replica and BatchNorm keeps running statistics per replica.
+    The stacked parameters are leaf tensors: an element-wise optimizer (Adam) over them is equivalent
+    to K independent optimizers.
+    '''
+    def __init__(self, models):
+        self.n_models = len(models)
+        self.base = copy.deepcopy(models[0]).to('meta')
+        self.params, self.buffers = stack_module_state(models)
+
+    def to(self, device):
+        self.params = {name: param.detach().to(device).requires_grad_() for name, param in self.params.items()}
+        self.buffers = {name: buffer.to(device) for name, buffer in self.buffers.items()}
+        return self
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def train(self, mode=True):
+        self.base.train(mode)
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def _call(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    def __call__(self, x, same_input=False):
+        '''
+        Outputs (K, B, ...) of all the replicas on their batches x (K, B, ...), or on the same batch x (B, ...)
+        '''
+        return vmap(self._call, in_dims=(0, 0, None if same_input else 0), randomness='different')(
+            self.params, self.buffers, x)
+
+    def state(self):
+        '''
+        All the stacked tensors (parameters and buffers)
+        '''
+        return {**self.params, **self.buffers}
+
+    def state_dict(self, k):
+        '''
+        State dict of replica k, it can be loaded in a model of the architecture
+        '''
+        return {name: tensor[k].detach().clone() for name, tensor in self.state().items()}
+
+    def predict(self, x, use_auxiliary_loss=False):
+        '''
+        Ensemble prediction in one pass: inequality probabilities averaged over the replicas
+        '''
+        self.eval()
+        with torch.no_grad():
+            output = self(x, same_input=True)
+            if use_auxiliary_loss:
+                output = output[0]
+            return output.softmax(dim=-1).mean(dim=0)
+
+
+def replica_errors(ensemble, inputs, targets, batch_size, device, use_auxiliary_loss=False, precision='fp32'):
+    '''
+    Error rates (K,) of the replicas, each one on its own set: inputs (K, N, 2, 14, 14), targets (K, N)
+    '''
+    ensemble.eval()
+    errors = torch.zeros(ensemble.n_models, dtype=torch.long, device=device)
+    with torch.no_grad(), precision_context(device, precision):
+        for start in range(0, inputs.size(1), batch_size):
+            output = ensemble(inputs[:, start:start + batch_size].to(device))
+            if use_auxiliary_loss:
+                output = output[0]
+            errors += (output.argmax(dim=-1) != targets[:, start:start + batch_size].to(device)).sum(dim=1)
+    return errors.float().cpu() / inputs.size(1)
+
+
+def train_ensemble(model, *model_params, n_models=10, use_auxiliary_loss=False, aux_loss_weight=0.3, nb_epochs=25,
+                   weight_decay=0.1, augment=False, batch_size=50, lr=1e-3*0.5, percentage_val=0.1, verbose=1,
+                   precision='fp32'):
+    '''
+    Train 'n_models' replicas of model(*model_params) together (see Ensemble)
+
+    every replica has its own initialization, data set, split and augmentation stream, as the experiments
+    of evaluate_model, and its own best model in validation (loaded at the end). The data sets are int32
+    index pairs into the shared uint8 digit banks (see IndexPairLoader), images are only gathered per batch.
+    The loss of the flattened K * B outputs is multiplied by K: every replica gets the gradient of its own loss.
+    Returns the ensemble and the (train, validation, test) errors (K, 3) of the replicas
+    '''
+    from training import get_criterion
+
+    device = ('cuda' if torch.cuda.is_available() else 'cpu')
+    N = 1000
+    train_images, train_labels = load_digit_bank(True)
+    test_images, test_labels = load_digit_bank(False)
+    train_sets, val_sets, test_sets, train_loaders, val_loaders = [], [], [], [], []
+    for _ in range(n_models):
+        train_input, train_target, train_classes = bank_to_index_pairs(N, train_labels)
+        test_input, test_target, test_classes = bank_to_index_pairs(N, test_labels)
+        (train_input, train_target, train_classes,
+            val_input, val_target, val_classes) = random_split(train_input, train_target, train_classes, percentage_val)
+        train_loaders.append(IndexPairLoader(train_images, train_labels, train_input, batch_size=batch_size,
+                                             use_auxiliary_loss=use_auxiliary_loss, augment=augment))
+        val_loaders.append(IndexPairLoader(train_images, train_labels, val_input, batch_size=batch_size,
+                                           use_auxiliary_loss=use_auxiliary_loss))
+        train_sets.append((train_input, train_target))
+        val_sets.append((val_input, val_target))
+        test_sets.append((test_input, test_target))
+
+    models = [model(*model_params) for _ in range(n_models)]
+    if verbose >= 1: print('Number of parameters of every replica: {}'.format(count_parameters(models[0])))
+    ensemble = Ensemble(models).to(device)
+    criterion = get_criterion(use_auxiliary_loss, aux_loss_weight)
+    optimizer = optim.Adam(ensemble.parameters(), lr=lr, weight_decay=weight_decay)
+
+    best_state = {name: tensor.detach().clone() for name, tensor in ensemble.state().items()}
+    best_val_loss = torch.full((n_models,), float('inf'), device=device)
+    start = time.time()
+    for epoch in range(nb_epochs):
+        ensemble.train()
+        train_loss = torch.zeros((), device=device)
+        for loader in train_loaders:
+            loader.set_epoch(epoch)
+        for batches in zip(*train_loaders):
+            inputs = torch.stack([inputs for inputs, _ in batches]).to(device)
+            targets = torch.stack([targets for _, targets in batches]).to(device)
+            optimizer.zero_grad()
+            with precision_context(device, precision):
+                output = ensemble(inputs)
+                loss = n_models * criterion(to_float32(flatten_replicas(output)), targets.flatten(0, 1))
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.detach()
+        train_loss = train_loss.item() / (n_models * len(train_loaders[0]))
+
+        # validation loss of every replica
+        ensemble.eval()
+        val_loss = torch.zeros(n_models, device=device)
+        with torch.no_grad(), precision_context(device, precision):
+            for batches in zip(*val_loaders):
+                inputs = torch.stack([inputs for inputs, _ in batches]).to(device)
+                targets = torch.stack([targets for _, targets in batches]).to(device)
+                output = to_float32(ensemble(inputs))
+                val_loss += torch.stack([criterion(select_replica(output, k), targets[k]) for k in range(n_models)])
+        val_loss /= len(val_loaders[0])
+        # keep the best model in validation of every replica
+        improved = val_loss <= best_val_loss
+        best_val_loss = torch.where(improved, val_loss, best_val_loss)
+        with torch.no_grad():
+            for name, tensor in ensemble.state().items():
+                best_state[name][improved] = tensor.detach()[improved]
+        if verbose == 2:
+            print("Epoch", epoch+1, "/", nb_epochs, "train loss:", train_loss, "valid loss:", val_loss.tolist())
+
+    with torch.no_grad():
+        for name, tensor in ensemble.state().items():
+            tensor.copy_(best_state[name])
+    if verbose >= 1: print('Training time of {} replicas: {:.3f} seconds'.format(n_models, time.time() - start))
+
+    # the index pairs are only gathered into images for the final evaluation
+    errors = torch.stack([replica_errors(ensemble, torch.stack([gather_pairs(images, inputs) for inputs, _ in sets]),
+                                         torch.stack([targets for _, targets in sets]), 1000, device,
+                                         use_auxiliary_loss, precision)
+                          for sets, images in ((train_sets, train_images), (val_sets, train_images),
+                                               (test_sets, test_images))], dim=1)
+    if verbose >= 1:
+        test_input, test_target = test_sets[0]
+        test_input = gather_pairs(test_images, test_input)
+        ensemble_error = (ensemble.predict(test_input.to(device), use_auxiliary_loss).argmax(dim=1).cpu()
+                          != test_target).float().mean()
+        print('Test error of the ensemble: {0:.3f} %'.format(100 * float(ensemble_error)))
+    return ensemble, errors
+
+
+def evaluate_ensemble(model, *model_params, n_experiments=10, verbose=0, **kwargs):
+    '''
+    Same results as training.evaluate_model, but the 'n_experiments' experiments are trained
+    together as a vectorized ensemble (see train_ensemble and its keyword arguments)
+    '''
+    _, errors = train_ensemble(model, *model_params, n_models=n_experiments, verbose=verbose, **kwargs)
+    mean, std = errors.mean(dim=0), errors.std(dim=0)
+    if verbose >= 1:
+        for name, i in (('Training', 0), ('Validation', 1), ('Test', 2)):
+            print('{} Set: \n- Mean: {}\n- Standard Error: {}'.format(name, mean[i], std[i]))
+    return (mean[0], std[0]), (mean[1], std[1]), (mean[2], std[2])
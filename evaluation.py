@@ -0,0 +1,111 @@
+import torch
+
+
+def precision_context(device, precision='fp32'):
+    '''
+    Mixed precision context: autocast to bfloat16 on the device type of 'device' if precision == 'bf16'
+    '''
+    if precision not in ('fp32', 'bf16'):
+        raise ValueError("precision must be 'fp32' or 'bf16', but you gave: {}".format(precision))
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+def percentile(values, q):
+    '''
+    Nearest-rank percentile 'q' (0-100) of a non-empty list of values (e.g. latencies)
+    '''
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def tensor_batches(inputs, targets, batch_size):
+    '''
+    Split (inputs, targets) in batches of 'batch_size' samples, the last one can be smaller
+    '''
+    for start in range(0, inputs.size(0), batch_size):
+        yield inputs[start:start + batch_size], targets[start:start + batch_size]
+
+
+def all_pairs_batches(images, classes, batch_size):
+    '''
+    Stream all the N*N ordered pairs of N single digit images (N, 1, 14, 14) in batches of two channel images,
+    together with the inequality targets, without materializing the pair set
+    '''
+    n = images.size(0)
+    for start in range(0, n * n, batch_size):
+        k = torch.arange(start, min(start + batch_size, n * n), device=images.device)
+        idx1, idx2 = k // n, k % n
+        inputs = torch.cat((images[idx1], images[idx2]), dim=1).float()
+        yield inputs, (classes[idx1] <= classes[idx2]).long()
+
+
+def all_pairs_error(model, device, use_auxiliary_loss=False, batch_size=None, precision='fp32', n_images=None,
+                    data_dir=None):
+    '''
+    Error rate of a model over all the ordered pairs of the MNIST test images (10000^2 pairs, or 'n_images'^2)
+
+    the pairs are streamed from the pooled test digit bank (see all_pairs_batches and load_digit_bank) in bounded
+    memory, the batch size is chosen automatically if not given (see auto_batch_size)
+    '''
+    from data_helpers import load_digit_bank
+    images, labels = load_digit_bank(False, data_dir)
+    if n_images is not None:
+        images, labels = images[:n_images], labels[:n_images]
+    if batch_size is None:
+        sample = torch.cat((images[:1], images[:1]), dim=1).float()
+        batch_size = auto_batch_size(model, sample.to(device))
+    return error_rate(model, all_pairs_batches(images, labels, batch_size), device, use_auxiliary_loss, precision)
+
+
+def auto_batch_size(model, sample, memory_budget=256 * 2**20, max_batch_size=4096):
+    '''
+    Largest batch size whose activations fit in 'memory_budget' bytes
+
+    the memory needed by one sample is estimated summing the outputs of all the layers of the model
+    during a forward step on 'sample' (a batch with a single input)
+    '''
+    sample_bytes = 0
+
+    def count_output(module, inputs, output):
+        nonlocal sample_bytes
+        for out in (output if isinstance(output, (tuple, list)) else [output]):
+            if torch.is_tensor(out):
+                sample_bytes += out.numel() * out.element_size()
+
+    model.eval()
+    layers = [module for module in model.modules() if len(list(module.children())) == 0]
+    handles = [layer.register_forward_hook(count_output) for layer in layers]
+    try:
+        with torch.inference_mode():
+            model(sample[:1])
+    finally:
+        for handle in handles:
+            handle.remove()
+    return int(max(1, min(max_batch_size, memory_budget // max(sample_bytes, 1))))
+
+
+def error_rate(model, batches, device, use_auxiliary_loss=False, precision='fp32'):
+    '''
+    Error rate of a model over an iterable of batches (inputs, targets)
+
+    batches are moved to 'device' one at a time (bounded memory, any number of samples, ragged last batch)
+    and the errors are counted on the device: the only host synchronization is the final result.
+    If targets contain also the classes (auxiliary loss) only the inequality (first column) is used.
+    With precision == 'bf16' the forward steps run under bfloat16 autocast.
+    '''
+    model.eval()
+    errors = torch.zeros((), dtype=torch.long, device=device)
+    n_samples = 0
+    with torch.inference_mode(), precision_context(device, precision):
+        for inputs, targets in batches:
+            inputs = inputs.to(device)
+            targets = targets.to(device)
+            if targets.dim() > 1:
+                targets = targets[:, 0]
+            outputs = model(inputs)
+            # select only the inequality predictions in case auxiliary loss is used in training
+            if use_auxiliary_loss or isinstance(outputs, tuple):
+                outputs = outputs[0]
+            errors += (outputs.argmax(dim=1) != targets).sum()
+            n_samples += targets.size(0)
+    return errors.float().cpu() / max(n_samples, 1)
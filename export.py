@@ -0,0 +1,181 @@
+import math
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from models import MLP, ConvNet, AuxConvBlock, DeepConvNet, ResNet, Siamese
+
+
+def fold_conv_bn(conv, bn, padding=None):
+    '''
+    Convolution followed by an eval mode BatchNorm folded in a single convolution
+
+    the zero padding (if given) is moved inside the convolution
+    '''
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding if padding is None else padding, bias=True)
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+def fold_bn_linear(bn, linear):
+    '''
+    Eval mode BatchNorm followed by a fully connected layer folded in a single fully connected layer
+    '''
+    fused = nn.Linear(linear.in_features, linear.out_features)
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        fused.weight.copy_(linear.weight * scale.view(1, -1))
+        fused.bias.copy_(linear.weight @ shift + linear.bias)
+    return fused
+
+
+def fuse_conv_block(block):
+    '''
+    ConvBlock (or the convolutional part of an AuxConvBlock) as padded convolution + ReLU
+    '''
+    if isinstance(block, AuxConvBlock):
+        block = block.conv_block
+    padding = math.ceil(0.5 * (block.kernel_size - 1))
+    return nn.Sequential(fold_conv_bn(block.conv, block.bn, padding), nn.ReLU())
+
+
+class FusedResidualBlock(nn.Module):
+    '''
+    ResidualBlock with BatchNorm folded in the convolutions and padding inside conv2
+    '''
+    def __init__(self, block):
+        super(FusedResidualBlock, self).__init__()
+        if block.stride != 1:
+            raise ValueError("Only residual blocks with stride 1 can be exported")
+        if block.conv_shortcut:
+            self.shortcut = fold_conv_bn(block.conv_sc, block.bn_sc)
+        else:
+            self.shortcut = nn.Identity()
+        self.conv1 = fold_conv_bn(block.conv1, block.bn1)
+        self.conv2 = fold_conv_bn(block.conv2, block.bn2, padding=math.ceil(0.5 * (block.kernel_size - 1)))
+        self.conv3 = fold_conv_bn(block.conv3, block.bn3)
+
+    def forward(self, x):
+        shortcut = self.shortcut(x)
+        x = F.relu(self.conv1(x))
+        x = F.relu(self.conv2(x))
+        x = self.conv3(x)
+        return F.relu(x + shortcut)
+
+
+class FusedSiamese(nn.Module):
+    '''
+    Siamese with fused back bone, both images of the pairs go through the back bone in a single pass
+    '''
+    def __init__(self, back_bone, dense):
+        super(FusedSiamese, self).__init__()
+        self.back_bone = back_bone
+        self.dense = dense
+
+    def forward(self, x):
+        x1, x2 = torch.split(x, split_size_or_sections=[1, 1], dim=1)
+        x1, x2 = torch.chunk(self.back_bone(torch.cat((x1, x2), dim=0)), 2)
+        return self.dense(x1 - x2)
+
+
+class InferenceModel(nn.Module):
+    '''
+    Exported model: takes the pairs of images and returns only the inequality logits
+    '''
+    def __init__(self, body, channels_last=True):
+        super(InferenceModel, self).__init__()
+        self.body = body
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.body(x)
+
+
+def fuse_deep_conv_net(model):
+    return nn.Sequential(*[fuse_conv_block(block) for block in model.conv_blocks],
+                         nn.AvgPool2d(kernel_size=14),
+                         nn.Flatten(),
+                         copy_module(model.dense))
+
+
+def copy_module(module):
+    copied = type(module)(module.in_features, module.out_features)
+    copied.load_state_dict(module.state_dict())
+    return copied
+
+
+def fuse_model(model):
+    '''
+    Inference version of a model of models.py
+
+    BatchNorm (with the running statistics) is folded in the weights, padding is moved inside
+    the convolutions, dropout and auxiliary branches are removed. The model is not modified.
+    '''
+    if isinstance(model, MLP):
+        layers = [copy_module(layer) if isinstance(layer, nn.Linear) else nn.ReLU() for layer in model.layers]
+        return nn.Sequential(nn.Flatten(), *layers)
+    if isinstance(model, ConvNet):
+        return nn.Sequential(fold_conv_bn(model.conv1, model.bn1), nn.ReLU(), nn.MaxPool2d(kernel_size=2),
+                             fold_conv_bn(model.conv2, model.bn2), nn.ReLU(), nn.MaxPool2d(kernel_size=2),
+                             nn.Flatten(),
+                             fold_bn_linear(model.bn3, model.fc1), nn.ReLU(),
+                             copy_module(model.fc2))
+    if isinstance(model, DeepConvNet):
+        return fuse_deep_conv_net(model)
+    if isinstance(model, ResNet):
+        return nn.Sequential(*[FusedResidualBlock(block) for block in model.blocks],
+                             nn.AvgPool2d(kernel_size=model.avg_pool.kernel_size),
+                             nn.Flatten(),
+                             copy_module(model.dense))
+    if isinstance(model, Siamese):
+        return FusedSiamese(fuse_deep_conv_net(model.back_bone), copy_module(model.dense))
+    raise TypeError("Cannot export a model of type {}".format(type(model).__name__))
+
+
+def check_parity(model, exported, inputs, atol=1e-4):
+    '''
+    Check that the exported model gives the same logits as the eager model (in evaluation mode)
+    '''
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            expected = model(inputs)
+            if isinstance(expected, tuple):
+                expected = expected[0]
+            actual = exported(inputs)
+    finally:
+        model.train(was_training)
+    max_error = (expected - actual).abs().max().item()
+    if max_error > atol:
+        raise RuntimeError("Exported model differs from the eager model (max abs error {:.2e})".format(max_error))
+    return max_error
+
+
+def export_model(model, example_input=None, path=None, channels_last=True, check=True):
+    '''
+    Export a model for CPU inference
+
+    the fused model (see fuse_model) is traced with channels_last layout, frozen and, if 'path' is given,
+    saved with torch.jit.save. With check == True the exported model is compared with the eager one.
+    '''
+    if example_input is None:
+        example_input = torch.rand(16, 2, 14, 14) * 255
+    inference_model = InferenceModel(fuse_model(model), channels_last).eval()
+    if channels_last:
+        inference_model = inference_model.to(memory_format=torch.channels_last)
+    with torch.no_grad():
+        exported = torch.jit.freeze(torch.jit.trace(inference_model, example_input))
+    if check:
+        check_parity(model, exported, example_input)
+    if path is not None:
+        torch.jit.save(exported, path)
+    return exported
@@ -0,0 +1,115 @@
+import sys
+import json
+import time
+import argparse
+import subprocess
+import torch
+
+
+# modules a scoring job does not need, they must not be imported by load_model
+HEAVY_MODULES = ["matplotlib", "torchvision", "plot", "training", "dlc_practical_prologue", "data_helpers"]
+
+
+def load_model(name='DeepConvNet', params=(False,), weights=None, scripted=None):
+    '''
+    Inference model in evaluation mode
+
+    the TorchScript artifact 'scripted' (see export.export_model) if given, otherwise the model 'name' of models.py
+    built with 'params' and the weights 'weights' (.pth). Only models.py is imported, and only in the second case.
+    '''
+    if scripted is not None:
+        return torch.jit.load(scripted, map_location='cpu').eval()
+    import models
+    model = getattr(models, name)(*params)
+    if weights is not None:
+        model.load_state_dict(torch.load(weights, map_location='cpu'))
+    return model.eval()
+
+
+def predict(model, pairs, batch_size=1000):
+    '''
+    Probabilities (N, 2) of the inequality classes of N pairs of images (N, 2, 14, 14)
+    '''
+    probabilities = []
+    with torch.inference_mode():
+        for inputs in torch.split(pairs, batch_size):
+            output = model(inputs.float())
+            if isinstance(output, tuple):
+                output = output[0]
+            probabilities.append(output.softmax(dim=1))
+    return torch.cat(probabilities)
+
+
+def startup_time(model_args, n_runs=5):
+    '''
+    Cold start of a scoring job: median wall time in seconds of 'n_runs' fresh interpreters that import this module
+    and load the model (command line arguments 'model_args'), together with the heavy modules they imported
+    '''
+    times = []
+    heavy_modules = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, __file__, "--startup_check"] + model_args,
+                                check=True, capture_output=True, text=True).stdout
+        times.append(time.perf_counter() - start)
+        heavy_modules = json.loads(output.strip().splitlines()[-1])
+    return sorted(times)[len(times) // 2], heavy_modules
+
+
+def model_arguments(args):
+    model_args = ["--model", args.model, "--params", args.params]
+    if args.weights is not None:
+        model_args += ["--weights", args.weights]
+    if args.scripted is not None:
+        model_args += ["--scripted", args.scripted]
+    return model_args
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score pairs of images with a trained model')
+    parser.add_argument('--model', type=str, default='DeepConvNet', help='Model class in models.py (default DeepConvNet)')
+    parser.add_argument('--params', type=str, default='[false]', help='Model parameters as a json list (default [false])')
+    parser.add_argument('--weights', type=str, default=None, help='Weights of the trained model (.pth)')
+    parser.add_argument('--scripted', type=str, default=None, help='Exported TorchScript model, instead of --model')
+    parser.add_argument('--input', type=str, default=None, help='Pairs of images to score (tensor N x 2 x 14 x 14, .pt)')
+    parser.add_argument('--output', type=str, default=None, help='Where to save the probabilities (.pt)')
+    parser.add_argument('--batch_size', type=int, default=1000, help='Batch size (default 1000)')
+    parser.add_argument('--all_pairs', type=int, nargs='?', const=10000, default=None,
+                        help='Error rate over all the ordered pairs of the first N test images (default N 10000)')
+    parser.add_argument('--startup_benchmark', action='store_true', default=False,
+                        help='Measure the cold start time (import and model loading) instead')
+    parser.add_argument('--n_runs', type=int, default=5, help='Runs of --startup_benchmark (default 5)')
+    parser.add_argument('--max_startup_ms', type=float, default=None,
+                        help='Fail --startup_benchmark if the cold start is slower than this')
+    parser.add_argument('--startup_check', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup_benchmark:
+        seconds, heavy_modules = startup_time(model_arguments(args), args.n_runs)
+        print("Cold start: {:.1f} ms (median of {} runs)".format(1000 * seconds, args.n_runs))
+        failed = False
+        if heavy_modules:
+            print("Unneeded modules imported:", ", ".join(heavy_modules))
+            failed = True
+        if args.max_startup_ms is not None and 1000 * seconds > args.max_startup_ms:
+            print("Slower than {:.1f} ms".format(args.max_startup_ms))
+            failed = True
+        sys.exit(1 if failed else 0)
+
+    model = load_model(args.model, json.loads(args.params), args.weights, args.scripted)
+    if args.startup_check:
+        print(json.dumps([name for name in HEAVY_MODULES if name in sys.modules]))
+        sys.exit(0)
+    if args.all_pairs is not None:
+        from evaluation import all_pairs_error
+        error = all_pairs_error(model, 'cpu', batch_size=args.batch_size, n_images=args.all_pairs)
+        print("Error rate over all the pairs of the first {} test images: {:.3f} %".format(args.all_pairs,
+                                                                                         100 * float(error)))
+    if args.input is not None:
+        probabilities = predict(model, torch.load(args.input), args.batch_size)
+        if args.output is not None:
+            torch.save(probabilities, args.output)
+            print("Probabilities saved in:", args.output)
+        else:
+            for probs in probabilities.tolist():
+                print("{:.6f}".format(probs[1]))
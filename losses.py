@@ -8,11 +8,24 @@ from torch.nn.modules.loss import _Loss
 from torch import Tensor
 
 
+def to_float32(preds):
+    '''
+    Cast the predictions of a model (tensor or nested tuples/lists of tensors) to float32,
+    so that the losses are computed in full precision also under autocast
+    '''
+    if torch.is_tensor(preds):
+        return preds.float()
+    return type(preds)(to_float32(pred) for pred in preds)
+
+
 class AuxiliaryLoss(_Loss):
     '''
     Auxiliary Loss
+
+    The digit predictions of all the auxiliary heads are stacked and computed with a single cross entropy,
+    the heads are averaged with 'head_weights' (default uniform, normalized to sum to 1)
     '''
-    def __init__(self, weight_classification, weight_inequality, reduction='mean'):
+    def __init__(self, weight_classification, weight_inequality, reduction='mean', head_weights=None):
         super().__init__(reduction=reduction)
         self.reduction = reduction
         if weight_inequality < 0.5:
@@ -22,28 +35,42 @@ class AuxiliaryLoss(_Loss):
             raise ValueError("weight_classification + weight_inequality must be equal to 1! But you gave: ", tot)
         self.weight_classification = weight_classification
         self.weight_inequality = weight_inequality
+        self.head_weights = head_weights
 
 
-    def forward(self, preds: tuple, target: Tensor):
+    def forward(self, preds: tuple, target: Tensor, return_breakdown=False):
         '''
         Forward Step
+
+        with return_breakdown == True returns also the detached losses of every head and digit
+        (flattened (n_heads, 2) tensor) followed by the inequality loss, without host synchronization
         '''
-        ineq, all_aux_preds = preds
-        loss_class1 = None
-        loss_class2 = None
-        for digits in all_aux_preds:
-            if loss_class1 is None and loss_class2 is None:
-                loss_class1 = F.cross_entropy(digits[:, :10], target[:, 1])
-                loss_class2 = F.cross_entropy(digits[:, 10:], target[:, 2])
-            else:
-                loss_class1 += F.cross_entropy(digits[:, :10], target[:, 1])
-                loss_class2 += F.cross_entropy(digits[:, 10:], target[:, 2])
-        
-        loss_class1 = loss_class1 / len(all_aux_preds)
-        loss_class2 = loss_class2 / len(all_aux_preds)
+        ineq, all_aux_preds = to_float32(preds)
+        n_heads = len(all_aux_preds)
+        digits = torch.stack(list(all_aux_preds)) # (n_heads, batch, 20)
+        batch_size = digits.size(1)
+        digits_target = target[:, 1:3].unsqueeze(0).expand(n_heads, batch_size, 2)
+        loss_heads = F.cross_entropy(digits.reshape(-1, 10), digits_target.reshape(-1), reduction='none')
+        loss_heads = loss_heads.view(n_heads, batch_size, 2).mean(dim=1) # (n_heads, 2)
+        loss_class = (loss_heads * self.get_head_weights(n_heads, digits.device).view(-1, 1)).sum()
+
         loss_ineq = F.cross_entropy(ineq, target[:,0])
-        loss = self.weight_classification * (loss_class1 + loss_class2) + self.weight_inequality * loss_ineq
+        loss = self.weight_classification * loss_class + self.weight_inequality * loss_ineq
+        if return_breakdown:
+            breakdown = torch.cat((loss_heads.detach().flatten(), loss_ineq.detach().view(1)))
+            return loss.mean(), breakdown
         return loss.mean()
 
+    def get_head_weights(self, n_heads, device):
+        '''
+        Normalized weights of the auxiliary heads
+        '''
+        if self.head_weights is None:
+            return torch.full((n_heads,), 1.0 / n_heads, device=device)
+        if len(self.head_weights) != n_heads:
+            raise ValueError("{} head weights given for {} auxiliary heads".format(len(self.head_weights), n_heads))
+        weights = torch.as_tensor(self.head_weights, dtype=torch.float32, device=device)
+        return weights / weights.sum()
+
 
 
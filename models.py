@@ -2,6 +2,8 @@ import torch
 from torch import nn
 from torch import optim
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+from contextlib import contextmanager, nullcontext
 import math
 
 
@@ -76,7 +78,7 @@ class ConvNet(nn.Module):
         x = F.max_pool2d(F.relu(self.bn2(self.conv2(x))), kernel_size=2)
         # fully connected layers
         x = F.relu(self.fc1(self.bn3(x.view(x.size()[0], -1))))
-        x = self.fc2(F.dropout(x)) 
+        x = self.fc2(F.dropout(x, training=self.training)) 
         
         return x
 
@@ -135,20 +137,88 @@ class AuxConvBlock(nn.Module):
         return x, preds
 
 
+@contextmanager
+def frozen_batch_norm(blocks):
+    '''
+    The BatchNorm layers of 'blocks' do not update their running statistics in the context
+    '''
+    layers = [module for block in blocks for module in block.modules()
+              if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.track_running_stats]
+    saved = [(layer.momentum, layer.num_batches_tracked.clone()) for layer in layers]
+    for layer in layers:
+        layer.momentum = 0.0
+    try:
+        yield
+    finally:
+        for layer, (momentum, num_batches_tracked) in zip(layers, saved):
+            layer.momentum = momentum
+            layer.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def forward_blocks(blocks, x):
+    '''
+    Forward step through a sequence of blocks, returns the output followed by the auxiliary predictions
+    '''
+    aux_preds = []
+    for block in blocks:
+        if isinstance(block, AuxConvBlock):
+            x, aux_pred = block(x)
+            aux_preds.append(aux_pred)
+        else:
+            x = block(x)
+    return (x, *aux_preds)
+
+
+def checkpointed_segment(blocks):
+    '''
+    forward_blocks on a segment of blocks, the BatchNorm statistics are frozen when it is recomputed in backward
+    '''
+    calls = 0
+
+    def run(x):
+        nonlocal calls
+        calls += 1
+        with frozen_batch_norm(blocks) if calls > 1 else nullcontext():
+            return forward_blocks(blocks, x)
+    return run
+
+
+def run_blocks(blocks, x, segment_size=None):
+    '''
+    Run a list of blocks (ConvBlock, AuxConvBlock, ResidualBlock), returns the output and the auxiliary predictions
+
+    With a segment_size (activation checkpointing, only when gradients are computed) the blocks are run
+    in segments of 'segment_size' blocks and only the inputs of the segments are kept for backward:
+    the activations inside a segment are recomputed during backward, trading compute for memory.
+    '''
+    if not segment_size or not torch.is_grad_enabled():
+        outputs = forward_blocks(blocks, x)
+        return outputs[0], list(outputs[1:])
+    aux_preds = []
+    for start in range(0, len(blocks), segment_size):
+        outputs = checkpoint(checkpointed_segment(blocks[start:start + segment_size]), x, use_reentrant=False)
+        x = outputs[0]
+        aux_preds += outputs[1:]
+    return x, aux_preds
+
+
 class DeepConvNet(nn.Module):
     '''
     DeepConvNet
 
     Convolutional Neural Network composed by 'depth' ConvBlocks, 
     followed by Average Pooling(14x14), DropOut and a final Fully Connected Layer.
+    With a checkpoint_segment_size the blocks are trained with activation checkpointing (see run_blocks).
 
     Total number of trainable parameters (with 10 blocks):  2 700 834
     '''
-    def __init__(self, use_auxiliary_loss, depth=10, n_classes=2, filters=128, in_channels=2):
+    def __init__(self, use_auxiliary_loss, depth=10, n_classes=2, filters=128, in_channels=2,
+                 checkpoint_segment_size=None):
         super(DeepConvNet, self).__init__()
         self.depth = depth
         self.use_auxiliary_loss = use_auxiliary_loss
         self.filters = filters
+        self.checkpoint_segment_size = checkpoint_segment_size
         blocks = []
         blocks.append(ConvBlock(in_channels=in_channels, filters=filters, kernel_size=3))
         for i in range(1, self.depth):
@@ -169,13 +239,7 @@ class DeepConvNet(nn.Module):
         '''
         Forward step
         '''
-        aux_preds = []
-        for block in self.conv_blocks:
-            if isinstance(block, AuxConvBlock):
-                x, aux_pred = block(x)
-                aux_preds.append(aux_pred)
-            else:
-                x = block(x)
+        x, aux_preds = run_blocks(self.conv_blocks, x, self.checkpoint_segment_size if self.training else None)
         x = self.avg_pool(x)
         x = torch.flatten(x, start_dim=1)
         x = self.dropout(x)
@@ -237,12 +301,15 @@ class ResNet(nn.Module):
     '''
     ResNet
 
+    With a checkpoint_segment_size the blocks are trained with activation checkpointing (see run_blocks).
+
     Total number of trainable parameters (with 10 blocks): 2 746 626
     '''
-    def __init__(self, depth, n_classes, input_channels=2, filters=32, input_size=14):
+    def __init__(self, depth, n_classes, input_channels=2, filters=32, input_size=14, checkpoint_segment_size=None):
         super(ResNet, self).__init__()
         self.depth = depth
         self.input_channels = input_channels
+        self.checkpoint_segment_size = checkpoint_segment_size
         # residual blocks keep the channels with same size as input images
         blocks = []
         blocks.append(ResidualBlock(filters=filters, input_channels=2, conv_shortcut=True))
@@ -255,8 +322,7 @@ class ResNet(nn.Module):
         self.dense = nn.Linear(in_features=4*filters, out_features=n_classes)
 
     def forward(self, x):
-        for block in self.blocks:
-            x = block(x)
+        x, _ = run_blocks(self.blocks, x, self.checkpoint_segment_size if self.training else None)
 
         x = self.avg_pool(x)
         x = torch.flatten(x, start_dim=1)
@@ -274,11 +340,18 @@ class Siamese(nn.Module):
     Siamese Network
 
     based on DeepConvNet
+
+    if single_pass == True both images of the pairs go through the back bone as one batch of 2B images
+    and the outputs are split back. In evaluation mode the outputs are the same as with two passes,
+    in training mode BatchNorm statistics are computed over the 2B images instead of each half.
+    checkpoint_segment_size enables activation checkpointing in the back bone (see DeepConvNet).
     '''
-    def __init__(self, use_auxiliary_loss, filters=128):
+    def __init__(self, use_auxiliary_loss, filters=128, single_pass=False, checkpoint_segment_size=None):
         super(Siamese, self).__init__()
         self.auxiliary_loss = use_auxiliary_loss
-        self.back_bone = DeepConvNet(use_auxiliary_loss, n_classes = 10, filters=filters, in_channels=1)
+        self.single_pass = single_pass
+        self.back_bone = DeepConvNet(use_auxiliary_loss, n_classes = 10, filters=filters, in_channels=1,
+                                     checkpoint_segment_size=checkpoint_segment_size)
         self.dense = nn.Linear(in_features = 10, out_features=2)
 
     def forward(self, x):
@@ -286,6 +359,19 @@ class Siamese(nn.Module):
         Forward step
         '''
         x1, x2 = torch.split(x, split_size_or_sections=[1,1], dim=1) # split channels
+        if self.single_pass:
+            batch_size = x.size(0)
+            x = torch.cat((x1, x2), dim=0)
+            if self.auxiliary_loss:
+                x, aux_preds = self.back_bone(x)
+                x1, x2 = torch.split(x, batch_size)
+                x = self.dense(torch.subtract(x1, x2))
+                aux_preds = [torch.cat(torch.split(aux_pred, batch_size), dim=1) for aux_pred in aux_preds]
+                aux_preds.append(torch.cat((x1, x2), dim=1))
+                return x, aux_preds
+            else:
+                x1, x2 = torch.split(self.back_bone(x), batch_size)
+                return self.dense(torch.subtract(x1, x2))
         if self.auxiliary_loss:
             x1, aux_preds1 = self.back_bone(x1)
             x2, aux_preds2 = self.back_bone(x2)
@@ -303,6 +389,43 @@ class Siamese(nn.Module):
             x = self.dense(x)
             return x
 
+    def embed(self, x, batch_size=1000):
+        '''
+        Back bone logits (N, 10) of N single digit images (N, 1, 14, 14), computed in batches
+
+        Inference only: the model is temporarily put in evaluation mode (dropout off, BatchNorm running
+        statistics) and no autograd graph is recorded.
+        '''
+        was_training = self.training
+        self.eval()
+        try:
+            embeddings = []
+            with torch.inference_mode():
+                for images in torch.split(x, batch_size):
+                    if self.auxiliary_loss:
+                        images, _ = self.back_bone(images)
+                    else:
+                        images = self.back_bone(images)
+                    embeddings.append(images)
+                return torch.cat(embeddings)
+        finally:
+            self.train(was_training)
+
+    def compare_all(self, x1, x2, batch_size=1000):
+        '''
+        All-pairs comparison
+
+        Compares every image of x1 (N, 1, 14, 14) with every image of x2 (M, 1, 14, 14).
+        The back bone runs once per image and, since dense(e1 - e2) = W e1 - W e2 + b,
+        the (N, M, 2) matrix of logits (same as forward on the pair (x1[i], x2[j]) in evaluation mode)
+        is obtained by broadcasting the projected embeddings. Use argmax(dim=2) to get the inequality matrix.
+        Like embed it always runs in evaluation mode, under torch.inference_mode().
+        '''
+        with torch.inference_mode():
+            proj1 = F.linear(self.embed(x1, batch_size), self.dense.weight)
+            proj2 = F.linear(self.embed(x2, batch_size), self.dense.weight)
+            return proj1.unsqueeze(1) - proj2.unsqueeze(0) + self.dense.bias
+
 
 
 ################################################################
@@ -0,0 +1,232 @@
+import os
+import json
+import math
+import argparse
+import torch
+
+from data_helpers import get_data_dir, load_digit_bank, bank_to_index_pairs, build_targets, gather_pairs
+
+
+# shards of int32 index pairs into the training digit bank
+CORPUS_FORMAT = "index_pairs"
+
+
+def corpus_dir(n_pairs, seed=0, holdout=0.1, data_dir=None):
+    '''
+    Default location of a pair corpus: <data_dir>/pair_corpus/<n_pairs>_seed<seed>_holdout<holdout>
+    '''
+    if data_dir is None:
+        data_dir = get_data_dir()
+    return os.path.join(data_dir, 'pair_corpus', '{}_seed{}_holdout{}'.format(n_pairs, seed, holdout))
+
+
+def holdout_size(n_images, holdout=0.1):
+    '''
+    Number of images at the end of the training digit bank that are never used by the corpus
+    '''
+    return math.ceil(n_images * holdout)
+
+
+def write_file(path, tensor):
+    '''
+    Write the bytes of a tensor to a temporary file and rename it, readers never see a partial file
+    '''
+    suffix = '.tmp' + str(os.getpid())
+    with open(path + suffix, 'wb') as f:
+        f.write(tensor.contiguous().numpy().tobytes())
+    os.replace(path + suffix, path)
+
+
+def build_pair_corpus(path, n_pairs, shard_size=100000, holdout=0.1, seed=0, data_dir=None):
+    '''
+    Pair Corpus Builder
+
+    Draws 'n_pairs' random pairs of two different images of the training digit bank (see load_digit_bank), excluding
+    the last 'holdout' fraction of the bank kept for validation, and writes them in shards of 'shard_size' pairs:
+    shard-<i>-pairs.i32 (int32 index pairs into the bank, shard_size x 2), 8 bytes per pair instead of a copy
+    of the two images. meta.json is written last: a corpus without it is incomplete.
+    '''
+    _, labels = load_digit_bank(True, data_dir)
+    n_images = labels.size(0) - holdout_size(labels.size(0), holdout)
+    os.makedirs(path, exist_ok=True)
+    n_shards = math.ceil(n_pairs / shard_size)
+    for i in range(n_shards):
+        size = min(shard_size, n_pairs - i * shard_size)
+        generator = torch.Generator().manual_seed(seed * 1000003 + i)
+        first = torch.randint(0, n_images, (size,), generator=generator)
+        # partners among the other n_images - 1 images: never an image with itself
+        second = torch.randint(0, n_images - 1, (size,), generator=generator)
+        second += (second >= first).long()
+        write_file(os.path.join(path, 'shard-{:05d}-pairs.i32'.format(i)), torch.stack((first, second), dim=1).int())
+    meta = {"n_pairs": n_pairs, "shard_size": shard_size, "n_shards": n_shards, "holdout": holdout, "seed": seed,
+            "format": CORPUS_FORMAT}
+    meta_path = os.path.join(path, 'meta.json')
+    with open(meta_path + '.tmp' + str(os.getpid()), 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp' + str(os.getpid()), meta_path)
+
+
+class PairCorpus:
+    '''
+    Memory-mapped Pair Corpus
+
+    Maps the index shards written by build_pair_corpus: pages are read from disk on demand, so the resident
+    memory does not grow with the corpus size. The images and classes come from the training digit bank.
+    '''
+    def __init__(self, path, data_dir=None):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get("format") != CORPUS_FORMAT:
+            raise ValueError("{} is not a corpus of index pairs, rebuild it".format(path))
+        self.path = path
+        self.images, self.labels = load_digit_bank(True, data_dir)
+        self.shard_sizes = [min(self.meta["shard_size"], self.meta["n_pairs"] - i * self.meta["shard_size"])
+                            for i in range(self.meta["n_shards"])]
+        self.shards = []
+        for i, size in enumerate(self.shard_sizes):
+            pairs = torch.from_file(os.path.join(path, 'shard-{:05d}-pairs.i32'.format(i)), shared=False,
+                                    size=size * 2, dtype=torch.int32)
+            self.shards.append(pairs.view(size, 2))
+
+    def __len__(self):
+        return self.meta["n_pairs"]
+
+    def gather(self, shard, idx):
+        '''
+        Pairs 'idx' of a shard: float images (B, 2, 14, 14) gathered from the digit bank, inequality targets and classes
+        '''
+        pairs = self.shards[shard][idx]
+        classes = self.labels[pairs.long()]
+        return gather_pairs(self.images, pairs), (classes[:, 0] <= classes[:, 1]).long(), classes
+
+    def pairs(self, n):
+        '''
+        The first 'n' pairs of the corpus (e.g. to measure the training error), as index pairs (n, 2)
+        into the digit bank (see gather_pairs) with their inequality targets and classes
+        '''
+        parts = []
+        for shard, size in enumerate(self.shard_sizes):
+            if n <= 0:
+                break
+            pairs = self.shards[shard][:min(n, size)].clone()
+            classes = self.labels[pairs.long()]
+            parts.append((pairs, (classes[:, 0] <= classes[:, 1]).long(), classes))
+            n -= size
+        return tuple(torch.cat(part) for part in zip(*parts))
+
+
+def load_pair_corpus(n_pairs, seed=0, holdout=0.1, shard_size=100000, path=None, data_dir=None):
+    '''
+    Pair corpus of 'n_pairs' pairs, built on the first call (see build_pair_corpus) and only mapped later
+    (corpora of an older format are rebuilt)
+    '''
+    if path is None:
+        path = corpus_dir(n_pairs, seed, holdout, data_dir)
+    meta_path = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f).get("format") != CORPUS_FORMAT:
+                os.remove(meta_path)
+    if not os.path.exists(meta_path):
+        build_pair_corpus(path, n_pairs, shard_size, holdout, seed, data_dir)
+    return PairCorpus(path, data_dir)
+
+
+def holdout_pairs(nb, holdout=0.1, data_dir=None):
+    '''
+    'nb' pairs of distinct images of the held-out end of the training digit bank (validation set of a corpus),
+    as index pairs into the whole bank (see bank_to_index_pairs)
+    '''
+    _, labels = load_digit_bank(True, data_dir)
+    start = labels.size(0) - holdout_size(labels.size(0), holdout)
+    idx, target, classes = bank_to_index_pairs(min(nb, (labels.size(0) - start) // 2), labels[start:])
+    return idx + start, target, classes
+
+
+class CorpusLoader:
+    '''
+    Streaming Loader of a PairCorpus
+
+    Every epoch visits the shards in a random order and the pairs of a shard in a random order,
+    batches never cross shards: only the pages of the current index shard are touched, the images of a batch
+    are gathered from the digit bank (see PairCorpus.gather). Like IndexPairLoader
+    the order only depends on (seed, epoch) so batches can be prefetched (PrefetchLoader) and resumed,
+    and with world_size > 1 process 'rank' takes every world_size-th batch (same number for all the processes).
+    '''
+    def __init__(self, corpus: PairCorpus, batch_size: int, use_auxiliary_loss: bool, seed=None, rank=0, world_size=1):
+        self.corpus = corpus
+        self.batch_size = batch_size
+        self.use_auxiliary_loss = use_auxiliary_loss
+        if seed is None:
+            seed = int(torch.randint(2**62, (1,)))
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.shard_batches = [math.ceil(size / batch_size) for size in corpus.shard_sizes]
+        self.epoch = 0
+        self._order = None
+        self._permutation = None
+
+    def __len__(self):
+        return sum(self.shard_batches) // self.world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def order(self, epoch):
+        '''
+        Shard order and cumulative number of batches of the shards in that order
+        '''
+        order = self._order
+        if order is None or order[0] != epoch:
+            generator = torch.Generator().manual_seed(hash((self.seed, epoch)) % 2**63)
+            shards = torch.randperm(len(self.shard_batches), generator=generator).tolist()
+            ends = []
+            for shard in shards:
+                ends.append((ends[-1] if ends else 0) + self.shard_batches[shard])
+            order = self._order = (epoch, shards, ends)
+        return order[1], order[2]
+
+    def permutation(self, epoch, shard):
+        '''
+        Order of the pairs of a shard at an epoch (cached: consecutive batches come from the same shard)
+        '''
+        # read once: prefetching threads may replace the cached permutation
+        permutation = self._permutation
+        if permutation is None or permutation[:2] != (epoch, shard):
+            generator = torch.Generator().manual_seed(hash((self.seed, epoch, shard)) % 2**63)
+            permutation = (epoch, shard, torch.randperm(self.corpus.shard_sizes[shard], generator=generator))
+            self._permutation = permutation
+        return permutation[2]
+
+    def batch(self, epoch, k):
+        '''
+        Batch k of epoch 'epoch' of this process
+        '''
+        shards, ends = self.order(epoch)
+        k = k * self.world_size + self.rank
+        position = next(i for i, end in enumerate(ends) if k < end)
+        shard = shards[position]
+        k -= ends[position] - self.shard_batches[shard]
+        idx = self.permutation(epoch, shard)
+        images, target, classes = self.corpus.gather(shard, idx[k * self.batch_size:(k + 1) * self.batch_size])
+        return images, build_targets(target, classes, self.use_auxiliary_loss)
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1
+        for k in range(len(self)):
+            yield self.batch(epoch, k)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a sharded pair corpus from the pooled MNIST digit bank')
+    parser.add_argument('--n_pairs', type=int, required=True, help='Number of pairs')
+    parser.add_argument('--shard_size', type=int, default=100000, help='Pairs per shard (default 100000)')
+    parser.add_argument('--holdout', type=float, default=0.1, help='Held-out fraction of the digits (default 0.1)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus (default 0)')
+    parser.add_argument('--path', type=str, default=None, help='Corpus directory (default <data_dir>/pair_corpus/...)')
+    args = parser.parse_args()
+
+    corpus = load_pair_corpus(args.n_pairs, args.seed, args.holdout, args.shard_size, args.path)
+    print("Corpus of {} pairs in {} shards: {}".format(len(corpus), len(corpus.shards), corpus.path))
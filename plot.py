@@ -2,7 +2,7 @@ import torch
 import matplotlib.pyplot as plt
 
 def plot_train_val(m_train, m_val, period, 
-                    al_param=False, metric='Cross-Entropy Loss', save=True, model_name=''):
+                    al_param=False, metric='Cross-Entropy Loss', save=True, model_name='', epochs=None):
     """
     Plot the evolution of the metric evaluated on the training and validation set during the trainining
     
@@ -14,6 +14,7 @@ def plot_train_val(m_train, m_val, period,
         metric: metric used (e.g. Cross-Entropy Loss, Error rate, Accuracy)
         save: equal to True if you want to save the plot
         model_name: name of your model (useful to save the plot with a proper name)
+        epochs: epochs at which the metric was evaluated (default: every 'period' epochs)
     Returns:
         plot
     """
@@ -23,9 +24,11 @@ def plot_train_val(m_train, m_val, period,
         al_steps = torch.Tensor(  range( 1, int(len(m_train)*period/al_param +1) )  ) *al_param
         for al_step in al_steps:
             plt.axvline(al_step, color='black')
-    plt.plot(torch.Tensor(range(1,len(m_train)+1))*period, m_train, 
+    if epochs is None:
+        epochs = torch.Tensor(range(1,len(m_val)+1))*period
+    plt.plot(epochs, m_train, 
                 color='c', marker='o', ls=':', label=metric+' train')
-    plt.plot(torch.Tensor(range(1,len(m_val)+1))*period, m_val, 
+    plt.plot(epochs, m_val, 
                 color='m', marker='o', ls=':', label=metric+' val')
     plt.axhline(min(m_val), ls=':',color='black')
     plt.xlabel('Number of Epochs')
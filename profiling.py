@@ -0,0 +1,146 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import torch
+from torch import nn
+
+
+class NullProfiler:
+    '''
+    Disabled profiler: every hook is a no-op, used by train when no profiler is given
+    '''
+    def phase(self, name):
+        return nullcontext()
+
+    def iterate(self, loader, name='data'):
+        return loader
+
+    def end_epoch(self):
+        return None
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Profiler:
+    '''
+    Training Profiler (opt-in)
+
+    Records the wall time of the training phases (data, forward, backward, optimizer, sync, validation,
+    checkpoint) and, through forward hooks, of every block of a model (see attach).
+    end_epoch collects the per-epoch breakdown, export_chrome_trace writes all the events
+    in the Chrome trace format (chrome://tracing, Perfetto).
+    With synchronize == True CUDA kernels are waited for at every measure.
+    '''
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.events = []
+        self.epochs = []
+        self._totals = defaultdict(float)
+        self._starts = {}
+        self._handles = []
+        self._origin = time.perf_counter()
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _record(self, name, category, start, end):
+        self.events.append((name, category, start - self._origin, end - start))
+        self._totals[category + '/' + name] += end - start
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Time the code in the context as training phase 'name'
+        '''
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._record(name, 'phase', start, self._now())
+
+    def iterate(self, loader, name='data'):
+        '''
+        Iterate over a loader timing the fetch of every batch as phase 'name'
+        '''
+        iterator = iter(loader)
+        while True:
+            start = self._now()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self._record(name, 'phase', start, self._now())
+            yield batch
+
+    def attach(self, model):
+        '''
+        Time every block of a model: the modules in its ModuleLists (e.g. DeepConvNet.conv_blocks,
+        ResNet.blocks) or, if it has none, its direct children
+        '''
+        blocks = []
+        for name, module in model.named_modules():
+            if isinstance(module, nn.ModuleList):
+                blocks += [(name + '.' + str(i), block) for i, block in enumerate(module)]
+        if not blocks:
+            blocks = list(model.named_children())
+        for name, block in blocks:
+            self._handles.append(block.register_forward_pre_hook(self._pre_hook(name)))
+            self._handles.append(block.register_forward_hook(self._post_hook(name)))
+
+    def detach(self):
+        '''
+        Remove the hooks of attach
+        '''
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            self._starts[name] = self._now()
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, output):
+            self._record(name, 'block', self._starts.pop(name), self._now())
+        return hook
+
+    def end_epoch(self):
+        '''
+        Close the current epoch, returns its breakdown {category/name: seconds}
+        '''
+        breakdown = dict(self._totals)
+        self.epochs.append(breakdown)
+        self._totals = defaultdict(float)
+        return breakdown
+
+    def summary(self, epoch=-1):
+        '''
+        Printable breakdown of an epoch (default the last one)
+        '''
+        breakdown = self.epochs[epoch]
+        phases = sum(seconds for key, seconds in breakdown.items() if key.startswith('phase/'))
+        lines = []
+        for key, seconds in sorted(breakdown.items(), key=lambda item: -item[1]):
+            share = " ({:5.1f} %)".format(100 * seconds / phases) if key.startswith('phase/') and phases > 0 else ""
+            lines.append("{:30s} {:10.4f} s{}".format(key, seconds, share))
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        '''
+        Write all the recorded events as a Chrome trace (json)
+        '''
+        threads = {'phase': 0, 'block': 1}
+        trace = {"traceEvents": [{"name": name,
+                                  "cat": category,
+                                  "ph": "X",
+                                  "ts": 1e6 * start,
+                                  "dur": 1e6 * duration,
+                                  "pid": 0,
+                                  "tid": threads[category]} for name, category, start, duration in self.events]}
+        with open(path, 'w') as f:
+            json.dump(trace, f)
@@ -0,0 +1,101 @@
+import io
+import json
+import time
+import argparse
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+import models
+from export import fuse_model
+from data_helpers import generate_pair_sets
+from evaluation import error_rate, tensor_batches
+
+
+def quantize_model(model, calibration_inputs, backend='x86', batch_size=100):
+    '''
+    Post-training static int8 quantization
+
+    the fused float model (see export.fuse_model) is prepared with FX graph mode quantization,
+    calibrated on 'calibration_inputs' (pairs of images) and converted to int8
+    '''
+    torch.backends.quantized.engine = backend
+    float_model = fuse_model(model).eval()
+    prepared = prepare_fx(float_model, get_default_qconfig_mapping(backend),
+                          example_inputs=(calibration_inputs[:1],))
+    with torch.no_grad():
+        for inputs in torch.split(calibration_inputs, batch_size):
+            prepared(inputs)
+    return convert_fx(prepared)
+
+
+def model_size(model):
+    '''
+    Size in bytes of the serialized weights of a model
+    '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def latency(model, inputs, n_runs=50, n_warmup=5):
+    '''
+    Median latency in milliseconds of a forward step on 'inputs'
+    '''
+    times = []
+    with torch.inference_mode():
+        for i in range(n_warmup + n_runs):
+            start = time.perf_counter()
+            model(inputs)
+            if i >= n_warmup:
+                times.append(time.perf_counter() - start)
+    return 1000 * sorted(times)[len(times) // 2]
+
+
+def quantization_report(model, n_calibration=500, n_test=1000, batch_size=100, backend='x86', verbose=1):
+    '''
+    Quantize a trained model and compare it with the float model
+
+    calibrates on 'n_calibration' training pairs of generate_pair_sets and returns the int8 model together with
+    the latency (batch of 'batch_size' pairs), the model size and the error rate on 'n_test' test pairs of both models
+    '''
+    (train_input, _, _,
+     test_input, test_target, _) = generate_pair_sets(max(n_calibration, n_test))
+    quantized = quantize_model(model, train_input[:n_calibration], backend, batch_size)
+    float_model = fuse_model(model).eval()
+
+    report = {}
+    for name, curr_model in (("float", float_model), ("int8", quantized)):
+        report[name] = {"latency_ms": latency(curr_model, test_input[:batch_size]),
+                        "size_bytes": model_size(curr_model),
+                        "test_error": float(error_rate(curr_model,
+                                                       tensor_batches(test_input[:n_test], test_target[:n_test], batch_size),
+                                                       'cpu'))}
+    report["speedup"] = report["float"]["latency_ms"] / report["int8"]["latency_ms"]
+    report["size_ratio"] = report["float"]["size_bytes"] / report["int8"]["size_bytes"]
+    report["test_error_change"] = report["int8"]["test_error"] - report["float"]["test_error"]
+    if verbose >= 1:
+        for name in ("float", "int8"):
+            print("{}: latency {:.3f} ms, size {:.2f} MB, test error {:.3f} %".format(
+                name, report[name]["latency_ms"], report[name]["size_bytes"] / 2**20, 100 * report[name]["test_error"]))
+        print("Speedup: {:.2f}x, size reduction: {:.2f}x, test error change: {:+.3f} %".format(
+            report["speedup"], report["size_ratio"], 100 * report["test_error_change"]))
+    return quantized, report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization of a trained model')
+    parser.add_argument('--model', type=str, default='DeepConvNet', help='Model class in models.py (default DeepConvNet)')
+    parser.add_argument('--params', type=str, default='[false]', help='Model parameters as a json list (default [false])')
+    parser.add_argument('--weights', type=str, required=True, help='Weights of the trained model (.pth)')
+    parser.add_argument('--output', type=str, default=None, help='Where to save the quantized model (torchscript)')
+    parser.add_argument('--n_calibration', type=int, default=500, help='Number of calibration pairs (default 500)')
+    parser.add_argument('--backend', type=str, default='x86', help='Quantized engine (default x86)')
+    args = parser.parse_args()
+
+    model = getattr(models, args.model)(*json.loads(args.params))
+    model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+    quantized, report = quantization_report(model, n_calibration=args.n_calibration, backend=args.backend)
+    if args.output is not None:
+        torch.jit.save(torch.jit.trace(quantized, torch.zeros(1, 2, 14, 14)), args.output)
+        print("The quantized model has been saved in:", args.output)
@@ -0,0 +1,161 @@
+import csv
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+
+RESULT_FIELDS = ["experiment_id",
+                 "model",
+                 "number_parameters",
+                 "use_auxiliary_loss",
+                 "learning_rate",
+                 "use_augmentation",
+                 "weight_decay",
+                 "nb_epochs",
+                 "num_experiments",
+                 "mean_train_errors",
+                 "std_train_errors",
+                 "mean_val_errors",
+                 "std_val_errors",
+                 "mean_test_errors",
+                 "std_test_errors",
+                 "elapsed_time"]
+
+
+def experiment_id(experiment):
+    '''
+    Unique name of an experiment of the grid, used to recognize the finished ones
+    '''
+    return "{}_aux={}_augment={}_epochs={}_lr={}_wd={}_n={}".format(experiment["model"],
+                                                                   experiment["use_auxiliary_loss"],
+                                                                   experiment["augment"],
+                                                                   experiment["nb_epochs"],
+                                                                   experiment["lr"],
+                                                                   experiment["weight_decay"],
+                                                                   experiment["n_experiments"])
+
+
+def read_results(results_path):
+    '''
+    Rows of the results file (empty if it does not exist yet)
+    '''
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def append_result(results_path, row):
+    '''
+    Append one row to the results file and flush it to disk
+    '''
+    new_file = not os.path.exists(results_path) or os.path.getsize(results_path) == 0
+    with open(results_path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def run_grid_experiment(job):
+    '''
+    Run one experiment of the grid (evaluate_model) in a worker process and return its result row
+
+    job = (experiment, number of threads, seed, checkpoint directory, checkpoint period, resume)
+    '''
+    experiment, n_threads, seed, checkpoint_dir, checkpoint_every, resume = job
+    import models
+    from training import evaluate_model
+
+    torch.set_num_threads(n_threads)
+    torch.manual_seed(seed)
+    model = getattr(models, experiment["model"])
+    params = experiment["model_params"]
+    run_checkpoint_dir = None
+    if checkpoint_dir is not None:
+        run_checkpoint_dir = os.path.join(checkpoint_dir, experiment_id(experiment))
+
+    start = time.time()
+    ((mean_train_error, std_train_error),
+        (mean_val_error, std_val_error),
+        (mean_test_error, std_test_error)) = evaluate_model(model,
+                                                            *params,
+                                                            n_experiments=experiment["n_experiments"],
+                                                            use_auxiliary_loss=experiment["use_auxiliary_loss"],
+                                                            aux_loss_weight=experiment["aux_loss_weight"],
+                                                            model_name=experiment_id(experiment),
+                                                            nb_epochs=experiment["nb_epochs"],
+                                                            weight_decay=experiment["weight_decay"],
+                                                            augment=experiment["augment"],
+                                                            batch_size=experiment["batch_size"],
+                                                            lr=experiment["lr"],
+                                                            percentage_val=experiment["percentage_val"],
+                                                            verbose=0,
+                                                            checkpoint_dir=run_checkpoint_dir,
+                                                            checkpoint_every=checkpoint_every,
+                                                            resume=resume)
+    return {"experiment_id": experiment_id(experiment),
+            "model": experiment["model"],
+            "number_parameters": models.count_parameters(model(*params)),
+            "use_auxiliary_loss": experiment["use_auxiliary_loss"],
+            "learning_rate": experiment["lr"],
+            "use_augmentation": experiment["augment"],
+            "weight_decay": experiment["weight_decay"],
+            "nb_epochs": experiment["nb_epochs"],
+            "num_experiments": experiment["n_experiments"],
+            "mean_train_errors": float(mean_train_error),
+            "std_train_errors": float(std_train_error),
+            "mean_val_errors": float(mean_val_error),
+            "std_val_errors": float(std_val_error),
+            "mean_test_errors": float(mean_test_error),
+            "std_test_errors": float(std_test_error),
+            "elapsed_time": time.time() - start}
+
+
+def run_grid(experiments, results_path, cpu_budget=None, threads_per_experiment=2, seed=0,
+             checkpoint_dir=None, checkpoint_every=1, resume=False):
+    '''
+    Experiment Grid Scheduler
+
+    Runs a list of experiments (dicts with the arguments of evaluate_model, see test.py) concurrently,
+    using at most 'cpu_budget' threads (default all the cores) with 'threads_per_experiment' threads each.
+    Every finished experiment is appended to the csv file 'results_path', experiments already
+    in the file are skipped so an interrupted grid restarts where it stopped.
+    The seed of an experiment depends only on its position in the grid.
+    With a 'checkpoint_dir' the experiments are also checkpointed (and resumed if resume == True).
+    Returns all the rows of the results file.
+    '''
+    if cpu_budget is None:
+        cpu_budget = os.cpu_count() or 1
+    done = set(row["experiment_id"] for row in read_results(results_path))
+    jobs = []
+    for i, experiment in enumerate(experiments):
+        if experiment_id(experiment) in done:
+            print("Skipping finished experiment:", experiment_id(experiment))
+        else:
+            jobs.append((experiment, threads_per_experiment, seed + i, checkpoint_dir, checkpoint_every, resume))
+
+    n_workers = max(1, min(len(jobs), cpu_budget // threads_per_experiment))
+    if jobs:
+        print("Running {} experiments with {} workers".format(len(jobs), n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(run_grid_experiment, job): experiment_id(job[0]) for job in jobs}
+            failed = []
+            for future in as_completed(futures):
+                try:
+                    row = future.result()
+                except Exception as e:
+                    print("Failed experiment: {} ({})".format(futures[future], e))
+                    failed.append(futures[future])
+                    continue
+                append_result(results_path, row)
+                print("Finished experiment: {} (test error: {:.4f}, {:.0f} seconds)".format(
+                    row["experiment_id"], row["mean_test_errors"], row["elapsed_time"]))
+        if failed:
+            raise RuntimeError("Some experiments failed: {}".format(failed))
+    return read_results(results_path)
@@ -0,0 +1,158 @@
+import os
+import math
+import json
+import random
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+
+# name: (low, high, log scale), the aux loss weight is only searched with the auxiliary loss
+SEARCH_SPACE = {"lr": (1e-4, 1e-2, True),
+                "weight_decay": (1e-5, 1e-1, True),
+                "aux_loss_weight": (0.05, 0.5, False)}
+
+
+def sample_config(rng, use_auxiliary_loss, space=SEARCH_SPACE):
+    '''
+    Random configuration of the search space (uniform or log-uniform in every range)
+    '''
+    config = {}
+    for name, (low, high, log) in space.items():
+        if name == "aux_loss_weight" and not use_auxiliary_loss:
+            continue
+        if log:
+            config[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            config[name] = rng.uniform(low, high)
+    return config
+
+
+def run_trial(job):
+    '''
+    Train one trial up to 'nb_epochs' epochs in a worker process, returns its validation error
+
+    job = (trial, nb_epochs, number of threads, resume, run_experiment keyword arguments)
+    the trial is checkpointed at its last epoch: with resume == True (promoted trials) it continues
+    from that checkpoint instead of training from scratch
+    '''
+    trial, nb_epochs, n_threads, resume, kwargs = job
+    import models
+    from training import run_experiment
+
+    torch.set_num_threads(n_threads)
+    torch.manual_seed(trial["seed"])
+    model = getattr(models, trial["model"])(*trial["model_params"])
+    _, _, errors, stats = run_experiment(model, nb_epochs=nb_epochs, checkpoint_path=trial["checkpoint_path"],
+                                         checkpoint_every=nb_epochs, resume=resume, verbose=0, plot=False,
+                                         save_weights=False, return_stats=True, **trial["config"], **kwargs)
+    return float(errors[1]), float(errors[2]), stats["best_epoch"]
+
+
+def successive_halving(model_name, model_params, use_auxiliary_loss=False, n_trials=27, min_epochs=3, eta=3,
+                       max_epochs=81, augment=False, batch_size=50, percentage_val=0.1, cpu_budget=None,
+                       threads_per_trial=2, seed=0, checkpoint_dir="./checkpoints/search", keep_checkpoints=False,
+                       verbose=1):
+    '''
+    Successive Halving Hyperparameter Search
+
+    Samples 'n_trials' configurations (lr, weight_decay and aux_loss_weight, see SEARCH_SPACE) and trains them
+    for 'min_epochs' epochs, then only the best 1 / eta of them (validation error of the best model in
+    validation) are trained further, up to min_epochs * eta^r epochs at rung r, until a single trial is
+    left or 'max_epochs' is reached. Promoted trials resume from their checkpoint, written in a new directory
+    of 'checkpoint_dir' for every search (never shared with other searches), deleted at the end of the search
+    unless keep_checkpoints == True.
+    The trials of a rung run concurrently with 'threads_per_trial' threads each within 'cpu_budget'
+    threads (default all the cores).
+    Returns the trials (config, epochs, validation and test errors) sorted from the best one.
+    '''
+    if cpu_budget is None:
+        cpu_budget = os.cpu_count() or 1
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    search_dir = tempfile.mkdtemp(prefix="{}_seed{}_".format(model_name, seed), dir=checkpoint_dir)
+    rng = random.Random(seed)
+    trials = []
+    for i in range(n_trials):
+        trials.append({"id": i,
+                       "model": model_name,
+                       "model_params": model_params,
+                       "config": sample_config(rng, use_auxiliary_loss),
+                       "seed": seed + i,
+                       "checkpoint_path": os.path.join(search_dir, "trial_{}.ckpt".format(i)),
+                       "epochs": 0,
+                       "val_error": None,
+                       "test_error": None})
+    kwargs = dict(use_auxiliary_loss=use_auxiliary_loss, augment=augment, batch_size=batch_size,
+                  percentage_val=percentage_val, model_name=model_name)
+
+    alive = trials
+    nb_epochs = min_epochs
+    total_epochs = 0
+    rung = 0
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, min(n_trials, cpu_budget // threads_per_trial)),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            while True:
+                # only promoted trials (rung > 0) continue from their checkpoint
+                jobs = [(trial, nb_epochs, threads_per_trial, rung > 0, kwargs) for trial in alive]
+                for trial, (val_error, test_error, _) in zip(alive, pool.map(run_trial, jobs)):
+                    total_epochs += nb_epochs - trial["epochs"]
+                    trial.update(epochs=nb_epochs, val_error=val_error, test_error=test_error)
+                alive = sorted(alive, key=lambda trial: trial["val_error"])
+                if verbose >= 1:
+                    print("Rung {}: {} trials trained for {} epochs, best validation error {:.3f} %".format(
+                        rung, len(alive), nb_epochs, 100 * alive[0]["val_error"]))
+                if len(alive) == 1 or nb_epochs >= max_epochs:
+                    break
+                alive = alive[:max(1, len(alive) // eta)]
+                nb_epochs = min(max_epochs, nb_epochs * eta)
+                rung += 1
+    finally:
+        # every trial checkpoint holds the model, the Adam moments and the best model
+        if not keep_checkpoints:
+            shutil.rmtree(search_dir, ignore_errors=True)
+            for trial in trials:
+                del trial["checkpoint_path"]
+
+    trials = sorted(trials, key=lambda trial: (-trial["epochs"], trial["val_error"]))
+    if verbose >= 1:
+        best = trials[0]
+        print("Best configuration: {} ({} epochs, validation error {:.3f} %, test error {:.3f} %)".format(
+            best["config"], best["epochs"], 100 * best["val_error"], 100 * best["test_error"]))
+        print("Trained {} epochs in total, {:.1f}x less than {} trials of {} epochs".format(
+            total_epochs, n_trials * max_epochs / total_epochs, n_trials, max_epochs))
+    return trials
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Successive halving search of lr, weight decay and aux loss weight')
+    parser.add_argument('--model', type=str, default='DeepConvNet', help='Model class in models.py (default DeepConvNet)')
+    parser.add_argument('--params', type=str, default='[false]', help='Model parameters as a json list (default [false])')
+    parser.add_argument('--use_auxiliary_loss', action='store_true', default=False, help='Train with the auxiliary loss')
+    parser.add_argument('--augment', action='store_true', default=False, help='Use data augmentation')
+    parser.add_argument('--n_trials', type=int, default=27, help='Number of sampled configurations (default 27)')
+    parser.add_argument('--min_epochs', type=int, default=3, help='Epochs of the first rung (default 3)')
+    parser.add_argument('--max_epochs', type=int, default=81, help='Maximum epochs of a trial (default 81)')
+    parser.add_argument('--eta', type=int, default=3, help='Only 1 / eta of the trials are promoted (default 3)')
+    parser.add_argument('--cpu_budget', type=int, default=None, help='Total number of threads (default all the cores)')
+    parser.add_argument('--threads_per_trial', type=int, default=2, help='Number of threads of each trial (default 2)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the search (default 0)')
+    parser.add_argument('--checkpoint_dir', type=str, default='./checkpoints/search', help='Checkpoints of the trials')
+    parser.add_argument('--keep_checkpoints', action='store_true', default=False,
+                        help='Keep the checkpoints of the trials after the search')
+    parser.add_argument('--output', type=str, default=None, help='Where to save the trials (json)')
+    args = parser.parse_args()
+
+    trials = successive_halving(args.model, json.loads(args.params), use_auxiliary_loss=args.use_auxiliary_loss,
+                                n_trials=args.n_trials, min_epochs=args.min_epochs, eta=args.eta,
+                                max_epochs=args.max_epochs, augment=args.augment, cpu_budget=args.cpu_budget,
+                                threads_per_trial=args.threads_per_trial, seed=args.seed,
+                                checkpoint_dir=args.checkpoint_dir, keep_checkpoints=args.keep_checkpoints)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(trials, f, indent=2)
+        print("Trials saved in:", args.output)
@@ -0,0 +1,234 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+from inference import load_model
+from evaluation import percentile
+
+
+def parse_request(request):
+    '''
+    Pair of images (2, 14, 14) of a request: {"pair": 2x14x14 list} or {"image1": 14x14 list, "image2": 14x14 list}
+    '''
+    if "pair" in request:
+        pair = torch.tensor(request["pair"], dtype=torch.float32)
+    else:
+        pair = torch.stack((torch.tensor(request["image1"], dtype=torch.float32),
+                            torch.tensor(request["image2"], dtype=torch.float32)))
+    if pair.shape != (2, 14, 14):
+        raise ValueError("A pair must have shape (2, 14, 14), got {}".format(tuple(pair.shape)))
+    return pair
+
+
+class MicroBatcher:
+    '''
+    Dynamic Micro-batching
+
+    Pairs submitted concurrently are queued and coalesced in batches of at most 'max_batch' pairs:
+    a batch is run as soon as it is full or 'max_wait' seconds after its first pair arrived.
+    The forward steps run in one background thread, so the event loop keeps accepting requests.
+    Keeps the latency (queueing + forward) of the last requests and the sizes of the last batches.
+    '''
+    def __init__(self, model, max_batch=64, max_wait=0.002, history=10000):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.n_requests = 0
+
+    async def submit(self, pair):
+        '''
+        Probabilities (2,) of the inequality classes of one pair (2, 14, 14)
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((pair, future, time.perf_counter()))
+        return await future
+
+    def forward(self, inputs):
+        with torch.inference_mode():
+            output = self.model(inputs)
+            if isinstance(output, tuple):
+                output = output[0]
+            return output.softmax(dim=1)
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        '''
+        Serve the queue forever
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            inputs = torch.stack([pair for pair, _, _ in batch])
+            try:
+                probabilities = await loop.run_in_executor(self.executor, self.forward, inputs)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            for (_, future, start), probs in zip(batch, probabilities):
+                if not future.done():
+                    future.set_result(probs)
+                self.latencies.append(end - start)
+            self.batch_sizes.append(len(batch))
+            self.n_requests += len(batch)
+
+    def metrics(self):
+        '''
+        Queue depth, number of requests, mean batch size and latency percentiles (ms) of the last requests
+        '''
+        latencies = list(self.latencies)
+        return {"queue_depth": self.queue.qsize(),
+                "n_requests": self.n_requests,
+                "mean_batch_size": sum(self.batch_sizes) / max(len(self.batch_sizes), 1),
+                "p50_ms": 1000 * percentile(latencies, 50) if latencies else None,
+                "p99_ms": 1000 * percentile(latencies, 99) if latencies else None}
+
+
+async def handle_connection(batcher, reader, writer):
+    '''
+    JSON lines protocol: every line is a request, answered (possibly out of order) by a line with the same "id"
+
+    {"id": 0, "pair": ...} -> {"id": 0, "probabilities": [p(first > second), p(first <= second)], "prediction": 0 or 1}
+    {"id": 1, "metrics": true} -> {"id": 1, "metrics": {...}}
+    '''
+    lock = asyncio.Lock()
+
+    async def respond(request):
+        try:
+            if request.get("metrics"):
+                response = {"metrics": batcher.metrics()}
+            else:
+                probs = await batcher.submit(parse_request(request))
+                response = {"probabilities": probs.tolist(), "prediction": int(probs.argmax())}
+        except Exception as e:
+            response = {"error": str(e)}
+        response["id"] = request.get("id")
+        async with lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    tasks = set()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                async with lock:
+                    writer.write((json.dumps({"id": None, "error": str(e)}) + "\n").encode())
+                continue
+            task = asyncio.ensure_future(respond(request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        writer.close()
+
+
+async def serve(model, host='127.0.0.1', port=8765, max_batch=64, max_wait=0.002):
+    '''
+    Run the inference server until cancelled
+    '''
+    batcher = MicroBatcher(model, max_batch, max_wait)
+    worker = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(batcher, reader, writer), host, port)
+    print("Serving on {}:{} (max batch {}, max wait {:.1f} ms)".format(host, port, max_batch, 1000 * max_wait))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+
+
+async def load_client(host, port, n_requests, latencies):
+    '''
+    One closed-loop client: sends a random pair, waits for the answer, and so on
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    for i in range(n_requests):
+        pair = [[[random.random() * 255 for _ in range(14)] for _ in range(14)] for _ in range(2)]
+        start = time.perf_counter()
+        writer.write((json.dumps({"id": i, "pair": pair}) + "\n").encode())
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def load_test(host='127.0.0.1', port=8765, n_requests=1000, concurrency=8):
+    '''
+    Throughput (requests per second) and client latency (p50, p99 in ms) with 'concurrency' concurrent clients
+    '''
+    latencies = []
+    per_client = max(1, n_requests // concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*[load_client(host, port, per_client, latencies) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {"concurrency": concurrency,
+            "n_requests": len(latencies),
+            "throughput": len(latencies) / elapsed,
+            "p50_ms": 1000 * percentile(latencies, 50),
+            "p99_ms": 1000 * percentile(latencies, 99)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-batching inference server for digit pair comparison')
+    parser.add_argument('mode', type=str, choices=['serve', 'load'], help='Run the server or the load generator')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='Port (default 8765)')
+    parser.add_argument('--model', type=str, default='DeepConvNet', help='Model class in models.py (default DeepConvNet)')
+    parser.add_argument('--params', type=str, default='[false]', help='Model parameters as a json list (default [false])')
+    parser.add_argument('--weights', type=str, default=None,
+                        help='Weights of the trained model (default ./model_weights/<model>.pth)')
+    parser.add_argument('--scripted', type=str, default=None, help='Exported TorchScript model, instead of --model')
+    parser.add_argument('--max_batch', type=int, default=64, help='Maximum pairs per batch (default 64)')
+    parser.add_argument('--max_wait_ms', type=float, default=2.0, help='Maximum wait of a batch in ms (default 2)')
+    parser.add_argument('--n_requests', type=int, default=1000, help='Requests of the load generator (default 1000)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                        help='Concurrent clients of the load generator (default 1 8 32)')
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        weights = args.weights if args.weights is not None else "./model_weights/{}.pth".format(args.model)
+        model = load_model(args.model, json.loads(args.params), weights, args.scripted)
+        try:
+            asyncio.run(serve(model, args.host, args.port, args.max_batch, args.max_wait_ms / 1000))
+        except KeyboardInterrupt:
+            pass
+    else:
+        for concurrency in args.concurrency:
+            result = asyncio.run(load_test(args.host, args.port, args.n_requests, concurrency))
+            print("{concurrency:4d} clients: {throughput:10.1f} requests/s  "
+                  "p50 {p50_ms:8.3f} ms  p99 {p99_ms:8.3f} ms".format(**result))
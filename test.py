@@ -1,31 +1,16 @@
 import torch
-
 from models import *
 from training import *
+from scheduler import run_grid
 import time
-#import pandas as pd
+import os
+import argparse
 
 
-def main():
+def experiment_grid():
     '''
-    Run all the experiments once
+    Declarative grid of all the experiments (arguments of evaluate_model)
     '''
-    exp_data = {"model": [],
-                "number_parameters": [],
-                "use_auxiliary_loss":[],
-                "learning_rate": [],
-                "use_augmentation":[],
-                "weight_decay" :[],
-                "num_experiments":[],
-                "mean_train_errors": [],
-                "std_train_errors": [],
-                "mean_val_errors": [],
-                "std_val_errors": [],
-                "mean_test_errors" :[],
-                "std_test_errors" :[],
-                }
-
-    models = [MLP, ConvNet, ResNet, DeepConvNet, DeepConvNet, Siamese, Siamese] 
     model_names = ["MLP", "ConvNet", "ResNet", "DeepConvNet", "DeepConvNet", "Siamese", "Siamese"] 
 
     model_params = [[2], # MLP 2 classes
@@ -53,74 +38,73 @@ def main():
     epochs = [25, 200] # 25 epochs without augmentation, 200 epochs with augmentation
     num_experiments = [1, 1] # 10 experiments for each model without augmentation, 10 for each model with augmentation
 
-    total_experiments = 14
-    i = 0
+    experiments = []
     for augment, nb_epochs, n_experiment in zip(use_augment, epochs, num_experiments):
-        for model, model_name, params in zip(models, model_names, model_params):
-
-            lr = learning_rates[model_name]
-            weight_decay = weight_decays[model_name]
+        for model_name, params in zip(model_names, model_params):
             use_aux_loss = (model_name == "Siamese" or model_name == "DeepConvNet") and params[0] == True
-            num_model_params = count_parameters(model(*params))
-
-            i+=1
-            print("\nExperiment: ({}/{})".format(i, total_experiments))
-            print("Model:", model_name, " Number of Parameters:", num_model_params)
-            print("Augmentations:", augment, " Epochs:", nb_epochs, " Use Auxiliary Loss:", use_aux_loss)
-
-            # saving experiment setup
-            exp_data["model"].append(model_name)
-            exp_data["number_parameters"].append(num_model_params)
-            exp_data["use_auxiliary_loss"].append(use_aux_loss)
-            exp_data["learning_rate"].append(lr)
-            exp_data["use_augmentation"].append(augment)
-            exp_data["weight_decay"].append(weight_decay)
-            exp_data["num_experiments"].append(n_experiment)
-
-            # run experiment
-            ((mean_train_error,std_train_error), 
-                (mean_val_error,std_val_error), 
-                (mean_test_error,std_test_error)) = evaluate_model(model,
-                                                             *params, 
-                                                            n_experiments = n_experiment,
-                                                            use_auxiliary_loss = use_aux_loss,
-                                                            aux_loss_weight=0.15, 
-                                                            model_name=model_name,
-                                                            nb_epochs = nb_epochs, 
-                                                            weight_decay = weight_decay,
-                                                            augment=augment,
-                                                            batch_size = 50,
-                                                            lr = lr, 
-                                                            percentage_val=0.1,
-                                                            verbose=0)
-            print('Training Set: \n- Error: {}'.format(mean_train_error) )
-            print('Validation Set: \n- Error: {}'.format(mean_val_error))
-            print('Test Set: \n- Error: {}'.format(mean_test_error))
-
-            # saving experiment results
-            exp_data["mean_train_errors"].append(mean_train_error.numpy())
-            exp_data["std_train_errors"].append(std_train_error.numpy())
-            exp_data["mean_val_errors"].append(mean_val_error.numpy())
-            exp_data["std_val_errors"].append(std_val_error.numpy())
-            exp_data["mean_test_errors"].append(mean_test_error.numpy())
-            exp_data["std_test_errors"].append(std_test_error.numpy())
-
+            experiments.append({"model": model_name,
+                                "model_params": params,
+                                "n_experiments": n_experiment,
+                                "use_auxiliary_loss": use_aux_loss,
+                                "aux_loss_weight": 0.15,
+                                "nb_epochs": nb_epochs,
+                                "weight_decay": weight_decays[model_name],
+                                "augment": augment,
+                                "batch_size": 50,
+                                "lr": learning_rates[model_name],
+                                "percentage_val": 0.1})
+    return experiments
+
+
+def main(results_path="experiments.csv", cpu_budget=None, threads_per_experiment=2,
+            resume=False, checkpoint_dir=None, checkpoint_every=1):
+    '''
+    Run all the experiments once
 
-    #df = pd.DataFrame(data=exp_data)
-    #df.to_csv("experiments.csv", index=False)
-    #print("Data updated on ./experiments.csv")
-    #print(df.head())
+    the experiments run concurrently (see scheduler.run_grid) and every result is appended to 'results_path':
+    running again skips the finished experiments. With a checkpoint_dir every experiment is checkpointed,
+    with resume == True interrupted experiments restart from their last checkpoint
+    '''
+    rows = run_grid(experiment_grid(), results_path,
+                    cpu_budget=cpu_budget,
+                    threads_per_experiment=threads_per_experiment,
+                    checkpoint_dir=checkpoint_dir,
+                    checkpoint_every=checkpoint_every,
+                    resume=resume)
+    for row in rows:
+        print("\nModel:", row["model"], " Number of Parameters:", row["number_parameters"])
+        print("Augmentations:", row["use_augmentation"], " Epochs:", row["nb_epochs"],
+                " Use Auxiliary Loss:", row["use_auxiliary_loss"])
+        print('Training Set: \n- Error: {}'.format(row["mean_train_errors"]))
+        print('Validation Set: \n- Error: {}'.format(row["mean_val_errors"]))
+        print('Test Set: \n- Error: {}'.format(row["mean_test_errors"]))
+    print("Data updated on", results_path)
 
     
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run all the experiments')
+    parser.add_argument('--results', type=str, default='experiments.csv',
+                        help='Results file, finished experiments are skipped (default experiments.csv)')
+    parser.add_argument('--cpu_budget', type=int, default=None,
+                        help='Total number of threads used by the experiments (default all the cores)')
+    parser.add_argument('--threads_per_experiment', type=int, default=2,
+                        help='Number of threads of each experiment (default 2)')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Resume interrupted experiments from their checkpoints (default False)')
+    parser.add_argument('--checkpoint_dir', type=str, default='./checkpoints',
+                        help='Where the checkpoints are written (default ./checkpoints)')
+    parser.add_argument('--checkpoint_every', type=int, default=5,
+                        help='Number of epochs between two checkpoints (default 5)')
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
     print("#"*100)
     print("\n>>> NOTE: total time for running all the experiments on Google Colab GPU is: 1 hour 40 minutes")
     print()
     print("#"*100)
     start = time.time()
-    main()
+    main(results_path=args.results, cpu_budget=args.cpu_budget, threads_per_experiment=args.threads_per_experiment,
+            resume=args.resume, checkpoint_dir=args.checkpoint_dir, checkpoint_every=args.checkpoint_every)
     end = time.time()
     print("Elapsed time in seconds:", end-start)
 
-            
-
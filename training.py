@@ -3,16 +3,23 @@ from torch import nn
 from torch import optim
 from torch.nn import functional as F
 import math
+import os
 from datetime import datetime
 from torch.nn.modules.loss import _Loss
 from torch import Tensor
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-import dlc_practical_prologue as prologue
-from plot import *
 from models import count_parameters, ConvNet
-from losses import AuxiliaryLoss
-from data_helpers import random_split, DigitsDataset
+from losses import AuxiliaryLoss, to_float32
+from data_helpers import random_split, PrefetchLoader, IndexPairLoader, load_digit_bank, bank_to_index_pairs, gather_pairs
+from pair_corpus import load_pair_corpus, holdout_pairs, CorpusLoader
+from checkpoint import CheckpointWriter, load_checkpoint, clone_state
+from evaluation import error_rate, tensor_batches, auto_batch_size, precision_context
+from profiling import Profiler, NULL_PROFILER
 
 
 def get_criterion(use_auxiliary_loss, weight_classification):
@@ -28,33 +35,103 @@ def get_criterion(use_auxiliary_loss, weight_classification):
 
 
 def run_experiment(model, use_auxiliary_loss, aux_loss_weight=0.3, nb_epochs = 25, weight_decay = 0.1, model_name="model", augment=True,
-                            batch_size = 50, lr = 1e-3*0.5, percentage_val=0.1, verbose=1, plot=True):
+                            batch_size = 50, lr = 1e-3*0.5, percentage_val=0.1, verbose=1, plot=True,
+                            weights_path=None, save_weights=True, checkpoint_path=None, checkpoint_every=1, resume=False,
+                            profile_path=None, precision='fp32', loader_threads=0, prefetch=4,
+                            val_interval=1, patience=None, min_delta=0.0, target_error=None, return_stats=False,
+                            rank=0, world_size=1, corpus_size=None):
     '''
     Run Experiment
+
+    The weights of the best model in validation are saved in 'weights_path'
+    (default ./model_weights/<model_name>.pth) if save_weights == True.
+    If 'checkpoint_path' is given a checkpoint is written every 'checkpoint_every' epochs,
+    with resume == True an interrupted experiment restarts from it (same data split).
+    If 'profile_path' is given the training is profiled (see profiling.py) and a Chrome trace is written there.
+    precision == 'bf16' trains and evaluates the model under bfloat16 autocast (losses in float32).
+    With loader_threads > 0 the training batches are prepared by background threads ('prefetch' batches ahead).
+    val_interval, patience, min_delta and target_error control validation and early stopping (see train),
+    with return_stats == True the statistics of the training (e.g. epochs and time to the best model)
+    are returned too.
+
+    With world_size > 1 this is process 'rank' of a distributed data-parallel training (see distributed.py):
+    the process group must be initialized and all the processes seeded in the same way. Every process trains
+    a DistributedDataParallel model on its shard of the training set, only rank 0 validates, checkpoints,
+    saves the weights and evaluates the model (the other ranks return None instead of the errors).
+    With resume == True rank 0 reads the checkpoint and broadcasts it, so all the ranks resume from the same epoch.
+    Early stopping (patience, target_error) is not supported in this mode.
+
+    With a corpus_size the model is trained on a memory-mapped corpus of 'corpus_size' pairs (see pair_corpus.py,
+    built on the first use) streamed in shuffled batches instead of N = 1000 pairs in memory, augment must be False.
+    It is validated on pairs of the held-out digits of the corpus (percentage_val * corpus_size pairs, at most 3000)
+    and the training error is measured on its first 10000 pairs.
     '''
+    distributed = world_size > 1
+    is_main = rank == 0
+    if not is_main: verbose = 0
+    if distributed and (patience is not None or target_error is not None):
+        raise ValueError("Early stopping is not supported in distributed training (only rank 0 validates)")
+    if corpus_size is not None and augment:
+        raise ValueError("augment is not supported with a corpus (its pairs are already random pairings)")
 
-    device = ('cuda' if torch.cuda.is_available() else 'cpu')
+    # gloo all-reduces CPU tensors
+    device = ('cuda' if torch.cuda.is_available() and not distributed else 'cpu')
     if verbose>=1: print("Device used: ", device)
 
-    # loading the data
+    checkpoint = None
+    if resume and checkpoint_path is not None and is_main and os.path.exists(checkpoint_path):
+        checkpoint = load_checkpoint(checkpoint_path)
+    if resume and distributed:
+        # only rank 0 writes the checkpoints (the other ranks may not see its file system):
+        # it decides whether to resume and sends the checkpoint to all the processes
+        checkpoint = [checkpoint]
+        dist.broadcast_object_list(checkpoint, src=0)
+        checkpoint = checkpoint[0]
+    if checkpoint is not None:
+        # regenerate the data split of the interrupted experiment
+        torch.set_rng_state(checkpoint['data_rng_state'])
+        if verbose>=1: print("Resuming from epoch {} of {}".format(checkpoint['epoch'], checkpoint_path))
+    data_rng_state = torch.get_rng_state()
+
+    # loading the data: pairs are int32 index pairs into the uint8 digit banks, gathered per batch
     N = 1000 
-    (train_input, train_target, train_classes,
-     test_input, test_target, test_classes) = prologue.generate_pair_sets(N)
-    if verbose>=1: print("Loading training and test set...")
+    train_images, train_labels = load_digit_bank(True)
+    test_images, test_labels = load_digit_bank(False)
+    if corpus_size is None:
+        train_input, train_target, train_classes = bank_to_index_pairs(N, train_labels)
+        test_input, test_target, test_classes = bank_to_index_pairs(N, test_labels)
+        if verbose>=1: print("Loading training and test set...")
 
-    # splitting the dataset
-    (train_input, train_target, train_classes, 
-        val_input, val_target, val_classes) = random_split(train_input, train_target,
-                                                                         train_classes, percentage_val)
-    if verbose>=1: print("Splitted the training set in training and validation set")
+        # splitting the dataset
+        (train_input, train_target, train_classes, 
+            val_input, val_target, val_classes) = random_split(train_input, train_target,
+                                                                             train_classes, percentage_val)
+        if verbose>=1: print("Splitted the training set in training and validation set")
+    else:
+        if distributed and not is_main:
+            # rank 0 builds the corpus on its first use, the other ranks only map it
+            dist.barrier()
+        corpus = load_pair_corpus(corpus_size)
+        if distributed and is_main:
+            dist.barrier()
+        val_input, val_target, val_classes = holdout_pairs(max(1, int(corpus_size * percentage_val)))
+        test_input, test_target, test_classes = bank_to_index_pairs(N, test_labels)
+        train_input, train_target, train_classes = corpus.pairs(min(corpus_size, 10 * N))
+        if verbose>=1: print("Mapped a corpus of {} training pairs".format(corpus_size))
 
-    train_ds = DigitsDataset(train_input, train_target, train_classes, augment=augment, 
-                                                        use_auxiliary_loss=use_auxiliary_loss)
-    train_loader = torch.utils.data.DataLoader(train_ds, batch_size=batch_size, shuffle=False)
+    if corpus_size is not None:
+        train_loader = CorpusLoader(corpus, batch_size, use_auxiliary_loss, rank=rank, world_size=world_size)
+    else:
+        train_loader = IndexPairLoader(train_images, train_labels, train_input, batch_size=batch_size,
+                                                            use_auxiliary_loss=use_auxiliary_loss, augment=augment,
+                                                            rank=rank, world_size=world_size)
+    if loader_threads > 0:
+        train_loader = PrefetchLoader(train_loader, n_threads=loader_threads, prefetch=prefetch)
 
-    val_ds = DigitsDataset(val_input, val_target, val_classes, augment=False, 
-                                        use_auxiliary_loss=use_auxiliary_loss)
-    val_loader = torch.utils.data.DataLoader(val_ds, batch_size=batch_size)
+    val_loader = None
+    if is_main:
+        val_loader = IndexPairLoader(train_images, train_labels, val_input, batch_size=batch_size,
+                                            use_auxiliary_loss=use_auxiliary_loss)
 
     if verbose>=1: print('Number of parameters of the model: {}'.format(count_parameters(model)))
     model = model.to(device)    
@@ -63,123 +140,305 @@ def run_experiment(model, use_auxiliary_loss, aux_loss_weight=0.3, nb_epochs = 2
     criterion = get_criterion(use_auxiliary_loss, aux_loss_weight)
     optimizer = optim.Adam(model.parameters(), lr = lr, weight_decay=weight_decay)
     if verbose>=1: print('Training...')
+    checkpoint_writer = CheckpointWriter(checkpoint_path) if checkpoint_path is not None and is_main else None
+    profiler = None
+    if profile_path is not None and is_main:
+        profiler = Profiler(synchronize=True)
+        profiler.attach(model)
+    if distributed:
+        # the parameters of rank 0 are broadcast to all the processes
+        model = DistributedDataParallel(model)
     start = time.time()
-    train_losses, val_losses = train(model, train_loader, val_loader, optimizer,
-                                            criterion, device, model_name, nb_epochs, verbose=verbose)
+    try:
+        train_losses, val_losses, stats = train(model, train_loader, val_loader, optimizer,
+                                                criterion, device, model_name, nb_epochs, verbose=verbose,
+                                                checkpoint=checkpoint, checkpoint_writer=checkpoint_writer,
+                                                checkpoint_every=checkpoint_every,
+                                                checkpoint_extra={'data_rng_state': data_rng_state},
+                                                profiler=profiler, precision=precision,
+                                                val_interval=val_interval, patience=patience,
+                                                min_delta=min_delta, target_error=target_error)
+    finally:
+        if checkpoint_writer is not None: checkpoint_writer.close()
+        if profiler is not None: profiler.detach()
     end = time.time()
+    if distributed:
+        model = model.module
+        if not is_main:
+            if return_stats:
+                return train_losses, val_losses, None, stats
+            return train_losses, val_losses, None
     if verbose >= 1: print('Training time: {0:.3f} seconds'.format(end-start))
-    path = "./model_weights/" + model_name + ".pth"
-    if verbose >= 1: print("The model weights have been correctly saved in: ", path)
-    
-    # load weights of best model in validation
-    model.load_state_dict(torch.load(path))
+    if verbose >= 1 and stats['best_epoch'] is not None:
+        print('Best model in validation after {} epochs and {:.3f} seconds'.format(stats['best_epoch'],
+                                                                                   stats['time_to_best']))
+    if profiler is not None and profiler.epochs:
+        profiler.export_chrome_trace(profile_path)
+        if verbose >= 1: print('Time breakdown of the last epoch:\n' + profiler.summary())
+        if verbose >= 1: print('The Chrome trace has been saved in: ', profile_path)
+
+    # the model holds the weights of the best model in validation
+    if save_weights:
+        if weights_path is None:
+            weights_path = "./model_weights/" + model_name + ".pth"
+        torch.save(model.state_dict(), weights_path)
+        if verbose >= 1: print("The model weights have been correctly saved in: ", weights_path)
 
     # evaluate the performances
-    train_error = test(model, use_auxiliary_loss, train_input, train_target, device)
+    train_input = gather_pairs(train_images, train_input)
+    val_input = gather_pairs(train_images, val_input)
+    test_input = gather_pairs(test_images, test_input)
+    train_error = test(model, use_auxiliary_loss, train_input, train_target, device, precision=precision)
     if verbose>=1: print('\nTraining error: {0:.3f} %'.format(train_error*100) )
-    val_error = test(model, use_auxiliary_loss, val_input, val_target, device)
+    val_error = test(model, use_auxiliary_loss, val_input, val_target, device, precision=precision)
     if verbose>=1: print('Validation error: {0:.3f} %'.format(val_error*100) )
-    test_error = test(model, use_auxiliary_loss, test_input, test_target, device)
+    test_error = test(model, use_auxiliary_loss, test_input, test_target, device, precision=precision)
     if verbose>=1: print('Test error: {0:.3f} %'.format(test_error*100) )
 
-    if plot==True: plot_train_val(train_losses, val_losses, period=1, model_name=model_name)
+    if plot==True and is_main:
+        from plot import plot_train_val
+        # training losses at the validated epochs
+        plot_train_val([train_losses[epoch - 1] for epoch in stats['val_epochs']], val_losses,
+                            period=val_interval, model_name=model_name, epochs=stats['val_epochs'])
 
+    if return_stats:
+        return train_losses, val_losses, (train_error, val_error, test_error), stats
     return train_losses, val_losses, (train_error, val_error, test_error)
 
 
-def train(model, train_loader, val_loader, optimizer, criterion, device, model_name="model", nb_epochs = 25, verbose=2):
+def train(model, train_loader, val_loader, optimizer, criterion, device, model_name="model", nb_epochs = 25, verbose=2,
+            checkpoint=None, checkpoint_writer=None, checkpoint_every=1, checkpoint_extra=None, profiler=None,
+            precision='fp32', val_interval=1, patience=None, min_delta=0.0, target_error=None):
     """
     Train a model
+
+    The weights of the best model in validation are kept as an in-memory snapshot
+    and loaded in the model at the end of the training.
+    If a checkpoint_writer is given, a checkpoint (model, optimizer, epoch, losses, best model)
+    is written in background every 'checkpoint_every' epochs and at the last epoch;
+    passing a loaded checkpoint resumes the training where it stopped.
+    A profiler (see profiling.py) records the time of every phase of the training.
+    With precision == 'bf16' forward steps run under bfloat16 autocast, the losses are computed in float32.
+
+    The model is validated every 'val_interval' epochs (and at the last one). The training stops early
+    if the validation loss did not improve by more than 'min_delta' for 'patience' epochs,
+    or as soon as the validation error is lower or equal than 'target_error'.
+    Returns the training and validation losses and the statistics of the run
+    (best_epoch, time_to_best, best_val_loss, best_val_error, epochs, stopped_early, val_epochs: the validated
+    epochs, elapsed: training time so far). After a resume the times include the training before the interruption.
+
+    A DistributedDataParallel model is trained on the shard of train_loader of its process, the training
+    losses are averaged over all the processes. The processes without val_loader (None) do not validate,
+    snapshots and checkpoints contain the weights of the wrapped model.
     """
+    if profiler is None:
+        profiler = NULL_PROFILER
+    # the wrapped model of DistributedDataParallel, used for validation (no collectives) and snapshots
+    module = getattr(model, 'module', model)
     train_losses = []
     val_losses = []
-    for epoch in range(nb_epochs):
-        train_loss = 0
+    best_state = None
+    start_epoch = 0
+    stats = {'best_epoch': None, 'time_to_best': None, 'best_val_loss': math.inf, 'best_val_error': None,
+             'epochs': 0, 'stopped_early': False, 'val_epochs': [], 'elapsed': 0.0}
+    if checkpoint is not None:
+        module.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        train_losses = list(checkpoint['train_losses'])
+        val_losses = list(checkpoint['val_losses'])
+        best_state = checkpoint['best_model']
+        start_epoch = checkpoint['epoch']
+        stats.update(checkpoint.get('stats', {}))
+        torch.set_rng_state(checkpoint['rng_state'])
+        if stats['stopped_early']:
+            start_epoch = nb_epochs
+    # patience counts from the last improvement of more than min_delta
+    last_improvement = stats['best_epoch'] if stats['best_epoch'] is not None else start_epoch
+    improvement_loss = stats['best_val_loss']
+    # times are cumulative over resumes
+    start = time.time() - stats['elapsed']
+    for epoch in range(start_epoch, nb_epochs):
+        # losses are accumulated on the device and read once per epoch
+        train_loss = torch.zeros((), device=device)
         model.train()
+        if hasattr(train_loader, 'set_epoch'):
+            train_loader.set_epoch(epoch)
         ##### TRAIN ######
-        for data in train_loader:
+        for data in profiler.iterate(train_loader):
             inputs, targets = data
             inputs = inputs.to(device)
             targets = targets.to(device)
-            optimizer.zero_grad()
-            output = model(inputs)
-            loss = criterion(output, targets)
-            loss.backward()
+            with profiler.phase('forward'):
+                optimizer.zero_grad()
+                with precision_context(device, precision):
+                    output = model(inputs)
+                    loss = criterion(to_float32(output), targets)
+            with profiler.phase('backward'):
+                loss.backward()
             # Update the Gradient
-            optimizer.step()
+            with profiler.phase('optimizer'):
+                optimizer.step()
             # Collect the Losses
-            train_loss += loss.data.item()
-        train_loss = train_loss / len(train_loader)
+            train_loss += loss.detach()
+        with profiler.phase('sync'):
+            if isinstance(model, DistributedDataParallel):
+                dist.all_reduce(train_loss)
+                train_loss /= dist.get_world_size()
+            train_loss = train_loss.item() / len(train_loader)
         train_losses.append(train_loss)
+        stats['epochs'] = epoch + 1
+        stop = False
 
         ##### VALIDATION #####
-        model.eval()
-        val_loss = 0
-        for data in val_loader:
-            inputs, targets = data
-            inputs = inputs.to(device)
-            targets = targets.to(device)
-            with torch.no_grad():
-                val_preds = model(inputs)
-                val_loss += criterion(val_preds, targets).data.item()
-        val_loss = val_loss / len(val_loader) 
-        val_losses.append(val_loss)
-        # save best model in validation
-        if val_loss <= min(val_losses):
-            torch.save(model.state_dict(), "./model_weights/" + model_name + ".pth")
+        val_loss = None
+        if val_loader is not None and ((epoch + 1) % val_interval == 0 or epoch + 1 == nb_epochs):
+            with profiler.phase('validation'):
+                module.eval()
+                val_loss = torch.zeros((), device=device)
+                val_errors = torch.zeros((), device=device)
+                n_val = 0
+                for data in val_loader:
+                    inputs, targets = data
+                    inputs = inputs.to(device)
+                    targets = targets.to(device)
+                    with torch.no_grad(), precision_context(device, precision):
+                        val_preds = module(inputs)
+                        val_loss += criterion(to_float32(val_preds), targets)
+                        ineq_preds = val_preds[0] if isinstance(val_preds, tuple) else val_preds
+                        ineq_target = targets[:, 0] if targets.dim() > 1 else targets
+                        val_errors += (ineq_preds.argmax(dim=1) != ineq_target).sum()
+                    n_val += targets.size(0)
+                val_loss = val_loss.item() / len(val_loader) 
+                val_error = val_errors.item() / n_val
+                val_losses.append(val_loss)
+                stats['val_epochs'] = stats['val_epochs'] + [epoch + 1]
+            # keep best model in validation
+            with profiler.phase('checkpoint'):
+                if val_loss <= stats['best_val_loss']:
+                    best_state = clone_state(module.state_dict())
+                    stats.update(best_epoch=epoch + 1, time_to_best=time.time() - start,
+                                 best_val_loss=val_loss, best_val_error=val_error)
+            if val_loss < improvement_loss - min_delta:
+                improvement_loss = val_loss
+                last_improvement = epoch + 1
+            if patience is not None and epoch + 1 - last_improvement >= patience:
+                stop = True
+            if target_error is not None and val_error <= target_error:
+                stop = True
+        stats['stopped_early'] = stop and epoch + 1 < nb_epochs
+        stats['elapsed'] = time.time() - start
+
+        with profiler.phase('checkpoint'):
+            if checkpoint_writer is not None and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == nb_epochs or stop):
+                state = {'model_name': model_name,
+                         'epoch': epoch + 1,
+                         'model': module.state_dict(),
+                         'optimizer': optimizer.state_dict(),
+                         'train_losses': train_losses,
+                         'val_losses': val_losses,
+                         'best_model': best_state,
+                         'stats': stats,
+                         'rng_state': torch.get_rng_state()}
+                if checkpoint_extra is not None:
+                    state.update(checkpoint_extra)
+                checkpoint_writer.save(state)
+        profiler.end_epoch()
         if verbose==2:
             print("Epoch", epoch+1, "/", nb_epochs, "train loss:", train_loss, "valid loss:", val_loss)
-    return train_losses, val_losses
+        if stop:
+            if verbose >= 1: print("Early stopping at epoch {} (best epoch: {})".format(epoch + 1, stats['best_epoch']))
+            break
+    if best_state is not None:
+        module.load_state_dict(best_state)
+    return train_losses, val_losses, stats
 
 
-def test(model, use_auxiliary_loss, test_input, test_target, device):
+def test(model, use_auxiliary_loss, test_input, test_target, device, batch_size=None, precision='fp32'):
     '''
     Test a model
+
+    returns the error rate, the batch size is chosen automatically if not given (see evaluation.py)
     '''
-    model.eval()
-    test_input = test_input.to(device)
-    test_target = test_target.to(device)
-    preds = torch.empty(test_target.size(0), 2).to(device)
-    # avoid memory overflow
-    batch_size = 20
-    for i in range(0, test_input.size(0), batch_size):
-      inputs = test_input.narrow(0, i, batch_size)
-      with torch.no_grad():
-         # select only the first two columns in case auxiliary loss is used in training
-         if use_auxiliary_loss: outputs, _ = model(inputs)
-         else: outputs = model(inputs)
-      preds[i : i + batch_size, :] = outputs
-        
-    _, predicted_classes = preds.max(1)
-    test_error = (predicted_classes-test_target).abs().sum() / test_target.size(0)
-    return test_error
+    if batch_size is None:
+        batch_size = auto_batch_size(model, test_input[:1].to(device))
+    return error_rate(model, tensor_batches(test_input, test_target, batch_size), device, use_auxiliary_loss,
+                      precision)
 
 
 def evaluate_model(model, *model_params, n_experiments=10, use_auxiliary_loss=False, aux_loss_weight=0.3, model_name="model",
                     nb_epochs = 25, weight_decay = 0.1, augment=False,
-                    batch_size = 50, lr = 1e-3*0.5, percentage_val=0.1, verbose=0):
+                    batch_size = 50, lr = 1e-3*0.5, percentage_val=0.1, verbose=0,
+                    checkpoint_dir=None, checkpoint_every=1, resume=False, n_workers=1, seed=None, precision='fp32',
+                    loader_threads=0, val_interval=1, patience=None, min_delta=0.0, target_error=None, vectorized=False):
     '''
     Run 'n_experiments' experiments for a certain model and evaluate the performances
+
+    If 'checkpoint_dir' is given every experiment is checkpointed in <checkpoint_dir>/<model_name>_<i>.ckpt,
+    with resume == True interrupted experiments restart from their checkpoint.
+    If n_workers > 1 the experiments run in a pool of 'n_workers' processes, each one with
+    cpu_count / n_workers threads, its own seed (seed + i, seed drawn from the torch RNG if not given)
+    and its own weights file ./model_weights/<model_name>_<i>.pth
+    'loader_threads' is the number of data loading threads of every experiment (see run_experiment).
+    val_interval, patience, min_delta and target_error control validation and early stopping (see train).
+    With vectorized == True all the experiments are trained together as a vectorized ensemble
+    (see ensemble.py, checkpoints, workers and early stopping are not used).
     '''
     train_errors = []
     val_errors = []
     test_errors = []
     print('Number of experiments: {}'.format(n_experiments))
     print('Computing...')
+    if vectorized:
+        from ensemble import evaluate_ensemble
+        return evaluate_ensemble(model, *model_params, n_experiments=n_experiments,
+                                 use_auxiliary_loss=use_auxiliary_loss, aux_loss_weight=aux_loss_weight,
+                                 nb_epochs=nb_epochs, weight_decay=weight_decay, augment=augment,
+                                 batch_size=batch_size, lr=lr, percentage_val=percentage_val, verbose=verbose,
+                                 precision=precision)
+    experiments_kwargs = []
     for i in range(n_experiments):
-        curr_model = model(*model_params)
-        _, _, errors = run_experiment(curr_model,
-                                      use_auxiliary_loss=use_auxiliary_loss,
-                                      aux_loss_weight=aux_loss_weight,
-                                      nb_epochs=nb_epochs,
-                                      percentage_val=percentage_val,
-                                      batch_size=batch_size,
-                                      weight_decay=weight_decay,
-                                      lr=lr,
-                                      augment=augment,
-                                      model_name=model_name,
-                                      verbose=verbose,
-                                      plot=False)
+        checkpoint_path = None
+        if checkpoint_dir is not None:
+            checkpoint_path = os.path.join(checkpoint_dir, "{}_{}.ckpt".format(model_name, i))
+        experiments_kwargs.append(dict(use_auxiliary_loss=use_auxiliary_loss,
+                                       aux_loss_weight=aux_loss_weight,
+                                       nb_epochs=nb_epochs,
+                                       percentage_val=percentage_val,
+                                       batch_size=batch_size,
+                                       weight_decay=weight_decay,
+                                       lr=lr,
+                                       augment=augment,
+                                       model_name=model_name,
+                                       verbose=verbose,
+                                       plot=False,
+                                       checkpoint_path=checkpoint_path,
+                                       checkpoint_every=checkpoint_every,
+                                       resume=resume,
+                                       precision=precision,
+                                       loader_threads=loader_threads,
+                                       val_interval=val_interval,
+                                       patience=patience,
+                                       min_delta=min_delta,
+                                       target_error=target_error,
+                                       return_stats=True))
+
+    if n_workers > 1:
+        if seed is None:
+            seed = int(torch.randint(2**31, (1,)))
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        jobs = []
+        for i, kwargs in enumerate(experiments_kwargs):
+            kwargs["weights_path"] = "./model_weights/{}_{}.pth".format(model_name, i)
+            jobs.append((model, model_params, seed + i, n_threads, kwargs))
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(run_worker_experiment, jobs))
+    else:
+        results = []
+        for kwargs in experiments_kwargs:
+            _, _, errors, stats = run_experiment(model(*model_params), **kwargs)
+            results.append((errors, stats))
+
+    for errors, _ in results:
         train_errors.append(errors[0])
         val_errors.append(errors[1])
         test_errors.append(errors[2])
@@ -193,4 +452,47 @@ def evaluate_model(model, *model_params, n_experiments=10, use_auxiliary_loss=Fa
         print('Training Set: \n- Mean: {}\n- Standard Error: {}'.format(mean_train_error,std_train_error) )
         print('Validation Set: \n- Mean: {}\n- Standard Error: {}'.format(mean_val_error,std_val_error) )
         print('Test Set: \n- Mean: {}\n- Standard Error: {}'.format(mean_test_error,std_test_error) )
-    return (mean_train_error,std_train_error), (mean_val_error,std_val_error), (mean_test_error,std_test_error)
\ No newline at end of file
+        best = [stats for _, stats in results if stats['best_epoch'] is not None]
+        if best:
+            print('Best model in validation after {:.1f} epochs and {:.3f} seconds on average'.format(
+                sum(stats['best_epoch'] for stats in best) / len(best),
+                sum(stats['time_to_best'] for stats in best) / len(best)))
+    return (mean_train_error,std_train_error), (mean_val_error,std_val_error), (mean_test_error,std_test_error)
+
+
+def compare_precision(model, *model_params, verbose=1, **kwargs):
+    '''
+    Compare bfloat16 autocast with float32
+
+    runs evaluate_model (with the keyword arguments 'kwargs') in both precisions from the same seed,
+    returns the wall times, the error rates, the speedup of bf16 and its change of the error rates
+    '''
+    seed = int(torch.randint(2**31, (1,)))
+    report = {}
+    for precision in ('fp32', 'bf16'):
+        torch.manual_seed(seed)
+        start = time.time()
+        (_, (mean_val_error, _), (mean_test_error, _)) = evaluate_model(model, *model_params, precision=precision, **kwargs)
+        report[precision] = {'time': time.time() - start,
+                             'mean_val_error': float(mean_val_error),
+                             'mean_test_error': float(mean_test_error)}
+    report['speedup'] = report['fp32']['time'] / report['bf16']['time']
+    report['val_error_change'] = report['bf16']['mean_val_error'] - report['fp32']['mean_val_error']
+    report['test_error_change'] = report['bf16']['mean_test_error'] - report['fp32']['mean_test_error']
+    if verbose >= 1:
+        print('bf16 speedup: {0:.2f}x, test error: {1:.3f} % (fp32) -> {2:.3f} % (bf16)'.format(
+            report['speedup'], 100 * report['fp32']['mean_test_error'], 100 * report['bf16']['mean_test_error']))
+    return report
+
+
+def run_worker_experiment(job):
+    '''
+    Run one experiment of evaluate_model in a worker process
+
+    job = (model, model_params, seed, n_threads, run_experiment keyword arguments)
+    '''
+    model, model_params, seed, n_threads, kwargs = job
+    torch.set_num_threads(n_threads)
+    torch.manual_seed(seed)
+    _, _, errors, stats = run_experiment(model(*model_params), **kwargs)
+    return tuple(float(error) for error in errors), stats